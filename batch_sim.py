@@ -0,0 +1,212 @@
+#! /usr/bin/python3
+r"""
+Headless batch simulation of GameScene, for automated agents and level tests
+
+GameEnv runs one GameScene without the main loop and without a window: the
+caller resets it, steps the simulation with an action and gets back the
+observation. BatchSimulator fans the environments out to a pool of worker
+processes (each worker keeps its own share of them, their state never
+leaves the process) and returns the observations of all environments in
+one batch:
+
+    state   float32 array, one row per environment, columns in state_fields
+    frame   uint8 array of the downsampled screens (environments, h, w, 3),
+            only if a frame size was given. Rendering costs far more than
+            the simulation, leave it off when the state is enough
+
+Actions are the bitfields of mov_lib (e.g. mov_lib["upright"]), the keys of
+the bunny held down for frame_skip simulation steps (_sim_step each).
+
+Run as a script, it steps random actions and reports the throughput.
+
+Usage: batch_sim.py [environments] [steps] [--workers N] [--frame WxH]
+"""
+
+import os
+import time
+import argparse
+import concurrent.futures
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import numpy
+import pygame
+import hellokitty
+from libfalcon import init_subsystems, open_bundle, mov_lib_r
+
+# Columns of the state observations
+state_fields = ("x", "y", "velx", "vely", "jumping", "entities")
+# Valid actions, every allowed combination of the held keys
+actions = tuple(sorted(mov_lib_r))
+
+class GameEnv:
+    """One GameScene stepped by the caller. The display has to be set up
+       already, the dummy video driver is enough (see init_display)"""
+    def __init__(self, screen, frame_size=None, frame_skip=1):
+        self.screen = screen
+        # (width, height) of the frame observations, None for no frames
+        self.frame_size = frame_size
+        self.frame_skip = frame_skip
+        self.scene = None
+
+    def Reset(self):
+        """Start the level again, return the first observation"""
+        self.scene = hellokitty.GameScene(self.screen)
+        return self.Observe(0.0)
+
+    def Step(self, action):
+        """Hold the keys of action down for frame_skip simulation steps,
+           return the observation after them"""
+        if action not in mov_lib_r:
+            raise ValueError("Invalid action: {}".format(action))
+        self.scene.bunny.moving_dir = action
+        for i in range(self.frame_skip):
+            self.scene.Update(self.screen, hellokitty._sim_step)
+        return self.Observe(self.frame_skip * hellokitty._sim_step)
+
+    def State(self):
+        bunny = self.scene.bunny
+        store = self.scene.entities
+        alive = 0 if store == None else store.count - len(store.free)
+        return (bunny.body.posx, bunny.body.posy, bunny.body.velx,
+                bunny.body.vely, float(bunny.jumping), float(alive))
+
+    def Frame(self, elapsed):
+        """Render the scene and return the downsampled screen, (h, w, 3)"""
+        # The environments of the process share the screen, the dirty
+        # renderer can't rely on what the last frame has left there
+        self.scene.Invalidate()
+        self.scene.Render(self.screen, elapsed)
+        small = pygame.transform.smoothscale(self.screen, self.frame_size)
+        return pygame.surfarray.array3d(small).swapaxes(0, 1)
+
+    def Observe(self, elapsed):
+        """Return the state and the frame (or None), elapsed is the simulated
+           time since the last observation"""
+        frame = None
+        if self.frame_size != None:
+            frame = self.Frame(elapsed)
+        return self.State(), frame
+
+######################### WORKER PROCESS FUNCTIONS #############################
+
+# The environments of the worker process
+worker_envs = []
+
+def init_display(res_index):
+    """Set up pygame for the environments of this process, return the screen"""
+    init_subsystems(False)
+    open_bundle(hellokitty._asset_bundle)
+    hellokitty._active_res = res_index
+    return pygame.display.set_mode(hellokitty._resolutions[res_index])
+
+def init_worker(root, count, res_index, frame_size, frame_skip):
+    # Relative paths of the media files are resolved from the game directory
+    os.chdir(root)
+    screen = init_display(res_index)
+    worker_envs[:] = [GameEnv(screen, frame_size, frame_skip) for i in range(count)]
+
+def stack(observations):
+    states = numpy.array([state for state, frame in observations], numpy.float32)
+    frames = None
+    if observations and observations[0][1] is not None:
+        frames = numpy.stack([frame for state, frame in observations])
+    return states, frames
+
+def reset_worker():
+    return stack([env.Reset() for env in worker_envs])
+
+def step_worker(worker_actions):
+    return stack([env.Step(action)
+                  for env, action in zip(worker_envs, worker_actions)])
+
+################################################################################
+
+class BatchSimulator:
+    """Many GameEnvs in worker processes. A worker is a single process pool,
+       so the environments stay in the process which created them"""
+    def __init__(self, count, workers=None, frame_size=None, frame_skip=1,
+                 res_index=0):
+        if workers == None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, count))
+        self.count = count
+        self.frame_size = frame_size
+        root = os.path.dirname(os.path.abspath(__file__))
+
+        # Environments are split as evenly as possible
+        self.shares = [count // workers + (i < count % workers)
+                       for i in range(workers)]
+        self.pools = [concurrent.futures.ProcessPoolExecutor(1,
+                          initializer=init_worker,
+                          initargs=(root, share, res_index, frame_size, frame_skip))
+                      for share in self.shares]
+
+    def Gather(self, futures):
+        results = [future.result() for future in futures]
+        states = numpy.concatenate([states for states, frames in results])
+        observation = {"state": states}
+        if self.frame_size != None:
+            observation["frame"] = numpy.concatenate([frames for states, frames in results])
+        return observation
+
+    def Reset(self):
+        """Start every environment again, return the batched observation"""
+        return self.Gather([pool.submit(reset_worker) for pool in self.pools])
+
+    def Step(self, batch_actions):
+        """Step each environment with its action, return the batched
+           observation"""
+        if len(batch_actions) != self.count:
+            raise ValueError("Expected {} actions, got {}".format(
+                             self.count, len(batch_actions)))
+        futures = []
+        start = 0
+        for pool, share in zip(self.pools, self.shares):
+            futures.append(pool.submit(step_worker,
+                                       list(batch_actions[start:start + share])))
+            start += share
+        return self.Gather(futures)
+
+    def Close(self):
+        for pool in self.pools:
+            pool.shutdown()
+        self.pools = []
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch simulation throughput")
+    parser.add_argument("environments", type=int, nargs="?", default=64)
+    parser.add_argument("steps", type=int, nargs="?", default=500,
+                        help="batch steps to run")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--frame", type=parse_size, metavar="WxH",
+                        help="observe downsampled frames of this size too")
+    parser.add_argument("--frame-skip", type=int, default=1,
+                        help="simulation steps per action")
+    args = parser.parse_args()
+
+    simulator = BatchSimulator(args.environments, args.workers, args.frame,
+                               args.frame_skip)
+    try:
+        simulator.Reset()
+        random = numpy.random.RandomState(0)
+        choices = numpy.array(actions)
+        start = time.perf_counter()
+        for i in range(args.steps):
+            observation = simulator.Step(choices[random.randint(len(choices),
+                                                 size=args.environments)].tolist())
+        elapsed = time.perf_counter() - start
+    finally:
+        simulator.Close()
+
+    steps = args.environments * args.steps
+    print("{} environments in {} workers: {} steps in {:.2f} s, {:.0f} steps/sec "
+          "({:.0f} simulation steps/sec)".format(args.environments,
+          len(simulator.shares), steps, elapsed, steps / elapsed,
+          steps * args.frame_skip / elapsed))
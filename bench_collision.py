@@ -0,0 +1,59 @@
+#! /usr/bin/python3
+r"""
+Compare the linear scan collision check (the old GameScene.IsColliding) with
+the SpatialHash broadphase, for increasing number of blocking tiles.
+The query time of the grid should stay flat, the linear one grows with
+the number of tiles.
+"""
+
+import random
+import timeit
+import pygame
+from libfalcon import SpatialHash
+
+tile_size = 64
+probe_cnt = 1000
+
+class Tile:
+    def __init__(self, posx, posy):
+        self.rect = pygame.Rect(posx, posy, tile_size, tile_size)
+
+def linear_colliding(tiles, A):
+    for cur_sprite in tiles:
+        B = cur_sprite.rect
+        if (A.x < B.x + B.w) and (A.x + A.w > B.x) and \
+           (A.y < B.y + B.h) and (A.y + A.h > B.y):
+            return True
+    return False
+
+def build_level(tile_cnt):
+    # A long row of ground tiles with some random floating platforms, which
+    # is the typical layout of a level
+    tiles = [Tile(i * tile_size, 0) for i in range(tile_cnt // 2)]
+    width = len(tiles) * tile_size
+    for i in range(tile_cnt - len(tiles)):
+        tiles.append(Tile(random.randrange(width), -random.randrange(1, 20) * tile_size))
+    return tiles, width
+
+if __name__ == "__main__":
+    random.seed(0)
+    print("{:>8} {:>14} {:>14}".format("tiles", "linear [us]", "grid [us]"))
+    for tile_cnt in (10, 100, 1000, 10000, 100000):
+        tiles, width = build_level(tile_cnt)
+        grid = SpatialHash(tile_size)
+        for tile in tiles:
+            grid.Insert(tile)
+
+        # Bunny sized probes all over the level, like IsColliding gets them
+        probes = [pygame.Rect(random.randrange(width),
+                              -random.randrange(20 * tile_size), 40, 60)
+                  for i in range(probe_cnt)]
+
+        # Linear scan gets too slow to measure all probes on big levels
+        linear_probes = probes[:max(10, probe_cnt * 100 // tile_cnt)]
+        linear = timeit.timeit(lambda: [linear_colliding(tiles, A) for A in linear_probes],
+                               number=1) / len(linear_probes)
+        hashed = timeit.timeit(lambda: [grid.IsColliding(A) for A in probes],
+                               number=1) / len(probes)
+
+        print("{:>8} {:>14.2f} {:>14.2f}".format(tile_cnt, linear * 1e6, hashed * 1e6))
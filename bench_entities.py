@@ -0,0 +1,43 @@
+#! /usr/bin/python3
+r"""
+Time of one EntityStore.Step for increasing number of entities, falling onto
+and sliding along a ground with some blocks, like the ones of a level.
+"""
+
+import random
+import timeit
+import pygame
+import entities
+
+tile_size = 64
+level_tiles = 200
+
+class Look:
+    def __init__(self, width, height):
+        self.look = pygame.Surface((width, height))
+
+if __name__ == "__main__":
+    random.seed(0)
+    # Ground rows merged to chunk wide runs and some single blocks on top,
+    # similar to the blocking bodies of a Tilemap
+    blocking = [pygame.Rect(x, 0, 8 * tile_size, tile_size)
+                for x in range(0, level_tiles * tile_size, 8 * tile_size)]
+    blocking += [pygame.Rect(random.randrange(level_tiles) * tile_size, -tile_size,
+                             tile_size, tile_size) for i in range(level_tiles // 4)]
+
+    print("{:>9} {:>12} {:>16}".format("entities", "step [ms]", "per entity [us]"))
+    for entity_cnt in (100, 1000, 5000, 10000, 20000):
+        store = entities.EntityStore()
+        store.SetBlocking(blocking)
+        kind = store.AddKind(Look(24, 24))
+        for i in range(entity_cnt):
+            store.Spawn(kind, random.uniform(0, level_tiles * tile_size),
+                        random.uniform(-20 * tile_size, -2 * tile_size),
+                        random.uniform(-200, 200), 0.0)
+        # Let them land first, then measure the usual state of walking
+        for i in range(60):
+            store.Step(1 / 60, 2000)
+        steps = 60
+        step = timeit.timeit(lambda: store.Step(1 / 60, 2000), number=steps) / steps
+        print("{:>9} {:>12.3f} {:>16.3f}".format(entity_cnt, step * 1000,
+                                                  step / entity_cnt * 1e6))
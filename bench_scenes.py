@@ -0,0 +1,234 @@
+#! /usr/bin/python3
+r"""
+Headless end-to-end benchmark of the scene loop in hellokitty.main()
+
+The game runs with the dummy SDL video and audio drivers and without the fps
+limit, driven by a scripted input sequence: TitleScene -> GameScene, some
+running and jumping, then back to the title and quit. This is repeated for
+each resolution in _resolutions.
+
+Per-frame times are measured for these phases:
+    ProcessInput
+    Update          (sum of all simulation steps in the frame)
+    GenerateOutput  (rendering only, the time of Update is excluded)
+    present         (update_display)
+
+Simulation time advances 1/60 sec in each frame, independently of how fast
+the frames are rendered, so every run executes the same simulation steps.
+Results are written to a JSON file, to compare runs over time.
+
+Usage: bench_scenes.py [output_file] [gameplay_repeats]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import platform
+import functools
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+import hellokitty
+
+phases = ("ProcessInput", "Update", "GenerateOutput", "present")
+
+def down(key):
+    return pygame.event.Event(pygame.KEYDOWN, key=key, mod=0, unicode="", scancode=0)
+
+def up(key):
+    return pygame.event.Event(pygame.KEYUP, key=key, mod=0, unicode="", scancode=0)
+
+def key_events(key):
+    return [down(key), up(key)]
+
+def idle(frames):
+    return [[] for i in range(frames)]
+
+def build_script(gameplay_repeats):
+    """Return the list of event lists to post, one list for each frame"""
+    # Title menu: select "Start game" and enter GameScene
+    script = idle(30) + [key_events(pygame.K_DOWN)] + idle(30) + \
+             [key_events(pygame.K_RETURN)]
+
+    # Run right, jump over the block, run back to the left
+    for i in range(gameplay_repeats):
+        script += [[down(pygame.K_RIGHT)]] + idle(60)
+        script += [[down(pygame.K_UP)]] + idle(40)
+        script += [[up(pygame.K_UP)]] + idle(80)
+        script += [[up(pygame.K_RIGHT)], [down(pygame.K_LEFT)]] + idle(120)
+        script += [[up(pygame.K_LEFT)]] + idle(30)
+
+    # Back to the title, idle a bit, then quit
+    script += [key_events(pygame.K_ESCAPE)] + idle(60)
+    script += [[pygame.event.Event(pygame.QUIT)]]
+    return script
+
+def percentile(sorted_values, ratio):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1,
+                       math.ceil(ratio * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "mean_ms": (sum(values) / len(values) * 1000) if values else 0.0,
+        "max_ms": (values[-1] * 1000) if values else 0.0,
+    }
+
+class Recorder:
+    """Wrap the scene methods and update_display of hellokitty, to measure
+       each phase and to feed the scripted events in each frame"""
+    def __init__(self, script):
+        self.script = script
+        self.frame = 0
+        self.scene = None
+        self.current = dict.fromkeys(phases, 0.0)
+        self.frames = []
+        self.originals = []
+
+    def Timed(self, phase, function):
+        @functools.wraps(function)
+        def wrapper(scene, *args):
+            self.scene = scene.__class__.__name__
+            start = time.perf_counter()
+            result = function(scene, *args)
+            self.current[phase] += time.perf_counter() - start
+            return result
+        return wrapper
+
+    def Present(self, function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            start = time.perf_counter()
+            result = function(*args)
+            self.current["present"] = time.perf_counter() - start
+
+            # GenerateOutput includes the simulation steps, count only
+            # the time of the rendering
+            self.current["GenerateOutput"] -= self.current["Update"]
+            self.current["scene"] = self.scene
+            self.frames.append(self.current)
+            self.current = dict.fromkeys(phases, 0.0)
+
+            self.PostEvents()
+            return result
+        return wrapper
+
+    def PostEvents(self):
+        if self.frame < len(self.script):
+            for event in self.script[self.frame]:
+                pygame.event.post(event)
+        self.frame += 1
+
+    def Patch(self, owner, name, wrapper):
+        self.originals.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, wrapper(getattr(owner, name)))
+
+    def Install(self, frame_time):
+        for scene in (hellokitty.TitleScene, hellokitty.OptionsScene,
+                      hellokitty.QuitScene, hellokitty.GameScene):
+            self.Patch(scene, "ProcessInput",
+                       functools.partial(self.Timed, "ProcessInput"))
+            self.Patch(scene, "GenerateOutput",
+                       functools.partial(self.Timed, "GenerateOutput"))
+        self.Patch(hellokitty.GameScene, "Update",
+                   functools.partial(self.Timed, "Update"))
+        self.Patch(hellokitty, "update_display", self.Present)
+
+        # Simulated clock for the fixed time-step, advancing one frame time
+        # on each call (FixedTimestep.Advance calls it once per frame)
+        sim_time = [0.0]
+        def frame_clock():
+            sim_time[0] += frame_time
+            return sim_time[0]
+        self.Patch(hellokitty, "FixedTimestep",
+                   lambda cls: functools.partial(cls, timer=frame_clock))
+
+    def Uninstall(self):
+        for owner, name, original in reversed(self.originals):
+            setattr(owner, name, original)
+        self.originals = []
+
+def run_resolution(res_index, gameplay_repeats):
+    hellokitty._active_res = res_index
+    recorder = Recorder(build_script(gameplay_repeats))
+    recorder.Install(1.0 / 60)
+    # The scripted idle frames of the menus have to be rendered, too
+    hellokitty._idle_pacing = False
+    gc_policy = hellokitty.gc_policy
+    gc_policy.ResetStats()
+    start = time.perf_counter()
+    try:
+        # No fps limit, render as fast as possible
+        hellokitty.main(0)
+    finally:
+        recorder.Uninstall()
+        pygame.quit()
+    wall_time = time.perf_counter() - start
+
+    result = {
+        "resolution": list(hellokitty._resolutions[res_index]),
+        "frames": len(recorder.frames),
+        "wall_time_s": wall_time,
+        "fps": len(recorder.frames) / wall_time,
+        "phases": {},
+        "scenes": {},
+        # Collections during the frames, and the ones of the gc policy at the
+        # level load and the scene transitions
+        "gc": {
+            "collections": gc_policy.collections,
+            "pause_ms": gc_policy.pause * 1000,
+            "max_pause_ms": gc_policy.max_pause * 1000,
+            "policy_collections": gc_policy.manual_collections,
+            "policy_pause_ms": gc_policy.manual_pause * 1000,
+        },
+        "peak_memory": gc_policy.PeakMemory(),
+    }
+    for phase in phases:
+        result["phases"][phase] = summarize([f[phase] for f in recorder.frames])
+    for scene in sorted(set(f["scene"] for f in recorder.frames)):
+        frames = [f for f in recorder.frames if f["scene"] == scene]
+        result["scenes"][scene] = {"frames": len(frames)}
+        for phase in phases:
+            result["scenes"][scene][phase] = summarize([f[phase] for f in frames])
+    return result
+
+if __name__ == "__main__":
+    output = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else "bench_scenes.json")
+    gameplay_repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    # Relative paths of the media files are resolved from the game directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "results": [],
+    }
+    for res_index in range(len(hellokitty._resolutions)):
+        result = run_resolution(res_index, gameplay_repeats)
+        report["results"].append(result)
+        print("{}x{}: {} frames, {:.0f} fps".format(result["resolution"][0],
+              result["resolution"][1], result["frames"], result["fps"]))
+        for phase in phases:
+            stats = result["phases"][phase]
+            print("    {:<15} p50 {:7.3f} ms  p95 {:7.3f} ms  p99 {:7.3f} ms".format(
+                  phase, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+        print("    gc: {collections} collections in frames ({max_pause_ms:.3f} ms "
+              "max), {policy_collections} by the policy".format(**result["gc"]))
+
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print("Results written to", output)
@@ -0,0 +1,153 @@
+#! /usr/bin/python3
+r"""
+Asset build tool of the game
+
+1. Renames every file and directory of the media directories to lowercase,
+   so the lowercase lookup of load_media finds them (hidden entries are
+   skipped)
+2. Writes the pre-scaled variants of the sprite and tile images into
+   variant_dir, for each resolution in _resolutions, so the game doesn't
+   have to scale them on every launch. Sprites are trimmed to their opaque
+   pixels, the same way as load_variant does it.
+
+Only changed images are processed: the content hash of each image and the
+list of its variants are kept in a manifest in variant_dir. The variants of
+the changed images are made by a process pool.
+
+Usage: build_assets.py [--force]
+"""
+
+import os
+import sys
+import json
+import hashlib
+import concurrent.futures
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+import libfalcon
+import hellokitty
+
+manifest_name = "manifest.json"
+
+def rename_lowercase(root):
+    """Walk the tree depth-first, rename the entries with uppercase letters
+       to lowercase, return the paths of all files"""
+    files = []
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as entries:
+            entries = list(entries)
+        for entry in entries:
+            # Skip renaming hidden files and folders (starting with dot)
+            if entry.name.startswith("."):
+                continue
+
+            entry_path = entry.path
+            entry_lower = entry.name.lower()
+            if entry.name != entry_lower:
+                entry_path = os.path.join(path, entry_lower)
+                try:
+                    os.rename(entry.path, entry_path)
+                except FileNotFoundError:
+                    print("Couldn't rename: ", entry.path)
+                    continue
+            # Entries of the walk are not followed through symlinks
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry_path)
+            else:
+                files.append(os.path.relpath(entry_path, root))
+    return files
+
+def variant_specs():
+    """Return {image path: [(width, trim), ...]}, the variants which the game
+       loads at the resolutions in _resolutions"""
+    scalings = {}
+    for image, scaling in hellokitty._sprite_scalings.items():
+        scalings.setdefault(os.path.join(libfalcon.image_dir, image), set()).add((scaling, True))
+    # Tiles are as wide as 1/tiles_per_screen of the screen, never trimmed
+    with os.scandir(libfalcon.level_dir) as entries:
+        levels = [entry.path for entry in entries if entry.name.endswith(".lvl")]
+    for level in levels:
+        tiles_per_screen, tile_defs, rows = libfalcon.Tilemap.Parse(level)
+        for path, blocking, outline in tile_defs.values():
+            scalings.setdefault(path, set()).add((tiles_per_screen, False))
+
+    specs = {}
+    for path, path_scalings in scalings.items():
+        specs[libfalcon.normalize_path(path)] = sorted(
+            set((resolution[0] // scaling, trim)
+                for resolution in hellokitty._resolutions
+                for scaling, trim in path_scalings))
+    return specs
+
+def content_hash(path):
+    with open(path, "rb") as image_file:
+        return hashlib.sha1(image_file.read()).hexdigest()
+
+def build_variants(path, specs):
+    """Process pool job: write the variants of one image, return their paths"""
+    image = pygame.image.load(path)
+    outputs = []
+    for width, trim in specs:
+        output = libfalcon.variant_path(path, width, trim)
+        pygame.image.save(libfalcon.scale_image(image, width, trim), output)
+        outputs.append(output)
+    return outputs
+
+def load_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+if __name__ == "__main__":
+    force = "--force" in sys.argv[1:]
+    root = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(root)
+
+    files = set()
+    for media_dir in (libfalcon.image_dir, libfalcon.font_dir, libfalcon.level_dir):
+        files.update(libfalcon.normalize_path(os.path.join(media_dir, path))
+                     for path in rename_lowercase(media_dir))
+    os.makedirs(libfalcon.variant_dir, exist_ok=True)
+    manifest_path = os.path.join(libfalcon.variant_dir, manifest_name)
+    manifest = load_manifest(manifest_path)
+
+    # An image is processed again if its content, or the list of its
+    # variants changed, or a variant is missing
+    jobs = {}
+    new_manifest = {}
+    for path, specs in sorted(variant_specs().items()):
+        if path not in files:
+            print("Missing image:", path)
+            continue
+        record = {"hash": content_hash(path), "variants": [list(spec) for spec in specs]}
+        old = manifest.get(path)
+        outputs = [libfalcon.variant_path(path, width, trim) for width, trim in specs]
+        if force or old != record or not all(os.path.exists(o) for o in outputs):
+            jobs[path] = specs
+        new_manifest[path] = record
+
+    if jobs:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = {executor.submit(build_variants, path, specs): path
+                       for path, specs in jobs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                print("Built", futures[future], "->", ", ".join(future.result()))
+    # Variants of the images which are not used anymore
+    wanted = set(libfalcon.variant_path(path, width, trim)
+                 for path, record in new_manifest.items()
+                 for width, trim in record["variants"])
+    with os.scandir(libfalcon.variant_dir) as entries:
+        for entry in entries:
+            if entry.name != manifest_name and entry.path not in wanted:
+                os.remove(entry.path)
+
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(new_manifest, manifest_file, indent=1, sort_keys=True)
+    print("{} images, {} rebuilt".format(len(new_manifest), len(jobs)))
@@ -0,0 +1,416 @@
+r"""
+Content:
+    Struct-of-arrays entity store for large number of simple moving objects
+    (enemies, projectiles, collectibles), updated with NumPy in batches
+    Particle system for effects (dust, bursts), with pooled emitters
+
+NumPy is an optional dependency, the game runs without entities if it's not
+installed.
+"""
+
+################################### IMPORTS ####################################
+
+import numpy
+import pygame
+
+############################### SHARED LIBRARIES ###############################
+
+# Entity flags
+ALIVE    = 1
+GRAVITY  = 2
+# Stopped by the blocking rects
+BLOCKED  = 4
+# Set by Step if the entity stands on a blocking rect
+GROUNDED = 8
+# Collected when the player touches it
+PICKUP   = 16
+
+# Number of alpha levels of the particle looks, particles fade out through
+# them during their life
+particle_fade_levels = 4
+
+################################ CLASS TEMPLATES ###############################
+
+class EntityStore:
+    """Positions, velocities, sizes and flags of the entities in NumPy arrays.
+       Each entity has a kind, which gives its look when drawn. Kinds are
+       registered from sprites (e.g. GameObject), so entities look the same
+       as the sprite classes."""
+    def __init__(self, capacity=256, batch_size=256):
+        self.capacity = 0
+        # Number of used slots, slots above it are never alive
+        self.count = 0
+        self.free = []
+        self.looks = []
+        # Collision masks of the kinds
+        self.masks = []
+        # Entities are checked against the blocking rects in batches, which
+        # bounds the size of the (entities x rects) temporary arrays
+        self.batch_size = batch_size
+        self.blocking = numpy.zeros((0, 4), numpy.float64)
+        self.pos = numpy.zeros((0, 2), numpy.float64)
+        self.vel = numpy.zeros((0, 2), numpy.float64)
+        self.size = numpy.zeros((0, 2), numpy.float64)
+        self.flags = numpy.zeros(0, numpy.uint8)
+        self.kind = numpy.zeros(0, numpy.int32)
+        self.Grow(capacity)
+
+    def Grow(self, capacity):
+        """Resize the arrays, keeping the existing entities"""
+        def resized(array):
+            new = numpy.zeros((capacity,) + array.shape[1:], array.dtype)
+            new[:len(array)] = array
+            return new
+        self.pos = resized(self.pos)
+        self.vel = resized(self.vel)
+        self.size = resized(self.size)
+        self.flags = resized(self.flags)
+        self.kind = resized(self.kind)
+        self.capacity = capacity
+
+    def AddKind(self, sprite):
+        """Register the look of a sprite, return the kind for Spawn"""
+        self.looks.append(sprite.look)
+        mask = getattr(sprite, "mask", None)
+        if mask == None:
+            mask = pygame.mask.from_surface(sprite.look)
+        self.masks.append(mask)
+        return len(self.looks) - 1
+
+    def Spawn(self, kind, posx, posy, velx=0.0, vely=0.0, flags=GRAVITY | BLOCKED):
+        """Create an entity with the size of its look, return its index"""
+        if self.free:
+            index = self.free.pop()
+        else:
+            if self.count == self.capacity:
+                self.Grow(self.capacity * 2)
+            index = self.count
+            self.count += 1
+        look = self.looks[kind]
+        self.pos[index] = (posx, posy)
+        self.vel[index] = (velx, vely)
+        self.size[index] = look.get_size()
+        self.flags[index] = flags | ALIVE
+        self.kind[index] = kind
+        return index
+
+    def Despawn(self, index):
+        if self.flags[index] & ALIVE:
+            self.flags[index] = 0
+            self.free.append(index)
+
+    def Alive(self):
+        """Indices of the living entities"""
+        return numpy.nonzero(self.flags[:self.count] & ALIVE)[0]
+
+    def SetBlocking(self, rects):
+        """Rects (anything with x, y, w, h) which stop BLOCKED entities"""
+        self.blocking = numpy.array([(r.x, r.y, r.x + r.w, r.y + r.h) for r in rects],
+                                    numpy.float64).reshape(-1, 4)
+
+    def Step(self, dt, gravity):
+        """Move all living entities, gravity is an acceleration (pixel/sec^2)"""
+        alive = self.Alive()
+        if not len(alive):
+            return
+        flags = self.flags[alive]
+        vel = self.vel[alive]
+        vel[:, 1] += numpy.where(flags & GRAVITY, gravity * dt, 0.0)
+        pos = self.pos[alive]
+
+        blocked = numpy.nonzero(flags & BLOCKED)[0]
+        flags &= ~numpy.uint8(GROUNDED)
+        if len(self.blocking) and len(blocked):
+            size = self.size[alive]
+            # Batches of entities near to each other, so each batch has to be
+            # checked only against the few rects around it
+            blocked = blocked[numpy.argsort(pos[blocked, 0], kind="stable")]
+            # Move and resolve the axes separately, so entities slide along
+            # the surfaces they hit
+            for axis in (0, 1):
+                pos[:, axis] += vel[:, axis] * dt
+                for start in range(0, len(blocked), self.batch_size):
+                    self.Resolve(axis, blocked[start:start + self.batch_size],
+                                 pos, vel, size, flags)
+        else:
+            pos += vel * dt
+
+        self.pos[alive] = pos
+        self.vel[alive] = vel
+        self.flags[alive] = flags
+
+    def Resolve(self, axis, batch, all_pos, all_vel, all_size, all_flags):
+        """Push the entities of batch (indices into the arrays) out of the
+           blocking rects on one axis"""
+        pos = all_pos[batch]
+        vel = all_vel[batch]
+        size = all_size[batch]
+        flags = all_flags[batch]
+
+        left, top = pos[:, 0:1], pos[:, 1:2]
+        right, bottom = left + size[:, 0:1], top + size[:, 1:2]
+        # Only the rects overlapping the bounding box of the batch matter
+        rects = self.blocking
+        rects = rects[(rects[:, 0] < right.max()) & (rects[:, 2] > left.min()) &
+                      (rects[:, 1] < bottom.max()) & (rects[:, 3] > top.min())]
+        # Entities x rects overlap matrix, the same test as in IsColliding
+        hit = (left < rects[:, 2]) & (right > rects[:, 0]) & \
+              (top < rects[:, 3]) & (bottom > rects[:, 1])
+        colliding = hit.any(axis=1)
+        if not colliding.any():
+            return
+
+        moving_plus = vel[:, axis] > 0
+        moving_minus = vel[:, axis] < 0
+        # The nearest edge of the hit rects, in the direction of the movement
+        inf = numpy.inf
+        near_start = numpy.where(hit, rects[:, axis], inf).min(axis=1)
+        near_end = numpy.where(hit, rects[:, axis + 2], -inf).max(axis=1)
+
+        plus = colliding & moving_plus
+        minus = colliding & moving_minus
+        pos[plus, axis] = near_start[plus] - size[plus, axis]
+        pos[minus, axis] = near_end[minus]
+        vel[plus | minus, axis] = 0.0
+        if axis == 1:
+            flags[plus] |= GROUNDED
+
+        all_pos[batch] = pos
+        all_vel[batch] = vel
+        all_flags[batch] = flags
+
+    def Overlapping(self, rect):
+        """Indices of the living entities overlapping rect"""
+        alive = self.Alive()
+        pos = self.pos[alive]
+        size = self.size[alive]
+        hit = (pos[:, 0] < rect.x + rect.w) & (pos[:, 0] + size[:, 0] > rect.x) & \
+              (pos[:, 1] < rect.y + rect.h) & (pos[:, 1] + size[:, 1] > rect.y)
+        return alive[hit]
+
+    def Touching(self, rect, mask):
+        """Indices of the living entities overlapping the opaque pixels of
+           mask at rect. Masks are checked only for the overlapping rects."""
+        touching = []
+        for index in self.Overlapping(rect).tolist():
+            posx, posy = self.pos[index].astype(numpy.int32).tolist()
+            if mask.overlap(self.masks[self.kind[index]],
+                            (posx - rect.x, posy - rect.y)):
+                touching.append(index)
+        return numpy.array(touching, numpy.int64)
+
+    def Draw(self, screen, view):
+        """Blit the living entities inside view (world coordinates), the
+           upper-left corner of view is drawn to the upper-left corner of
+           the screen. Return the list of the blitted screen rects."""
+        alive = self.Alive()
+        pos = self.pos[alive]
+        size = self.size[alive]
+        visible = (pos[:, 0] < view.x + view.w) & (pos[:, 0] + size[:, 0] > view.x) & \
+                  (pos[:, 1] < view.y + view.h) & (pos[:, 1] + size[:, 1] > view.y)
+        screen_pos = (pos[visible] - (view.x, view.y)).astype(numpy.int32).tolist()
+        looks = self.looks
+        batch = [(looks[kind], xy) for kind, xy in
+                 zip(self.kind[alive][visible].tolist(), screen_pos)]
+        # Surface.blits is available since pygame 1.9.4
+        if hasattr(screen, "blits"):
+            return screen.blits(batch)
+        return [screen.blit(look, xy) for look, xy in batch]
+
+class Emitter:
+    """Settings of a particle effect. A burst is emitted at once when the
+       effect starts, then 'rate' particles/sec are emitted for 'duration'
+       seconds. Ranges are (min, max) tuples, angles are in degrees, 0 is
+       to the right, 90 is up."""
+    def __init__(self, colors, size=2, burst=0, rate=0.0, duration=0.0,
+                 speed=(20.0, 60.0), angle=(0.0, 360.0), life=(0.3, 0.6),
+                 gravity=0.0, spread=(0, 0)):
+        self.colors = colors
+        self.size = size
+        self.burst = burst
+        self.rate = rate
+        self.duration = duration
+        self.speed = speed
+        self.angle = angle
+        self.life = life
+        # Acceleration downwards (pixel/sec^2)
+        self.gravity = gravity
+        # Particles start in a (width, height) area around the origin
+        self.spread = spread
+
+class RunningEmitter:
+    """An effect in progress, instances are pooled by ParticleSystem"""
+    def __init__(self):
+        self.emitter = None
+        self.posx = 0.0
+        self.posy = 0.0
+        self.remaining = 0.0
+        # Fraction of a particle not emitted yet
+        self.accumulator = 0.0
+
+class ParticleSystem:
+    """Particles of all effects in fixed size NumPy arrays. The number of
+       particles never exceeds the capacity, new particles are dropped when
+       it's full. Living particles are kept packed at the start of the
+       arrays, so each update is a few operations on slices."""
+    def __init__(self, capacity=2048, seed=0):
+        self.capacity = capacity
+        self.count = 0
+        self.pos = numpy.zeros((capacity, 2), numpy.float64)
+        self.vel = numpy.zeros((capacity, 2), numpy.float64)
+        self.age = numpy.zeros(capacity, numpy.float64)
+        self.life = numpy.ones(capacity, numpy.float64)
+        self.gravity = numpy.zeros(capacity, numpy.float64)
+        self.size = numpy.zeros(capacity, numpy.int32)
+        # Index of the first (opaque) fade level of the look in self.looks
+        self.look = numpy.zeros(capacity, numpy.int32)
+        # Deterministic, so replays show the same effects
+        self.random = numpy.random.RandomState(seed)
+
+        self.emitters = {}
+        self.looks = []
+        self.running = []
+        self.emitter_pool = []
+        # Work done since the last TakeStats, for the profiler
+        self.stats = {"spawned": 0, "dropped": 0, "blits": 0}
+
+    def AddEmitter(self, name, emitter):
+        """Register an effect, and render the looks of its particles"""
+        emitter.looks = []
+        for color in emitter.colors:
+            emitter.looks.append(len(self.looks))
+            for level in range(particle_fade_levels):
+                look = pygame.Surface((emitter.size, emitter.size)).convert()
+                look.fill(color)
+                look.set_alpha(255 * (particle_fade_levels - level) //
+                               particle_fade_levels, pygame.RLEACCEL)
+                self.looks.append(look)
+        self.emitters[name] = emitter
+
+    def Start(self, name, posx, posy):
+        """Start an effect at the given position (world coordinates)"""
+        emitter = self.emitters[name]
+        if emitter.burst:
+            self.Emit(emitter, posx, posy, emitter.burst)
+        if emitter.rate and emitter.duration:
+            running = self.emitter_pool.pop() if self.emitter_pool else RunningEmitter()
+            running.emitter = emitter
+            running.posx = posx
+            running.posy = posy
+            running.remaining = emitter.duration
+            running.accumulator = 0.0
+            self.running.append(running)
+
+    def StopAll(self):
+        """Remove all particles and running effects"""
+        self.emitter_pool.extend(self.running)
+        self.running = []
+        self.count = 0
+
+    def Emit(self, emitter, posx, posy, number):
+        """Add particles of an effect, as many as fits under the capacity"""
+        start = self.count
+        end = min(start + number, self.capacity)
+        self.stats["dropped"] += number - (end - start)
+        number = end - start
+        if number <= 0:
+            return
+        random = self.random
+        part = slice(start, end)
+
+        angle = numpy.radians(random.uniform(emitter.angle[0], emitter.angle[1], number))
+        speed = random.uniform(emitter.speed[0], emitter.speed[1], number)
+        self.vel[part, 0] = numpy.cos(angle) * speed
+        self.vel[part, 1] = -numpy.sin(angle) * speed
+        self.pos[part, 0] = posx + random.uniform(-0.5, 0.5, number) * emitter.spread[0]
+        self.pos[part, 1] = posy + random.uniform(-0.5, 0.5, number) * emitter.spread[1]
+        self.age[part] = 0.0
+        self.life[part] = random.uniform(emitter.life[0], emitter.life[1], number)
+        self.gravity[part] = emitter.gravity
+        self.size[part] = emitter.size
+        self.look[part] = random.choice(emitter.looks, number)
+
+        self.count = end
+        self.stats["spawned"] += number
+
+    def Step(self, dt):
+        """Emit particles of the running effects, move the particles and
+           remove the ones at the end of their life"""
+        for running in self.running:
+            emitter = running.emitter
+            running.accumulator += emitter.rate * min(dt, running.remaining)
+            running.remaining -= dt
+            number = int(running.accumulator)
+            if number:
+                running.accumulator -= number
+                self.Emit(emitter, running.posx, running.posy, number)
+        if self.running:
+            finished = [r for r in self.running if r.remaining <= 0]
+            if finished:
+                self.running = [r for r in self.running if r.remaining > 0]
+                self.emitter_pool.extend(finished)
+
+        count = self.count
+        if not count:
+            return
+        vel = self.vel[:count]
+        vel[:, 1] += self.gravity[:count] * dt
+        self.pos[:count] += vel * dt
+        age = self.age[:count]
+        age += dt
+
+        # Pack the living particles to the start of the arrays
+        living = age < self.life[:count]
+        if not living.all():
+            keep = numpy.nonzero(living)[0]
+            for array in (self.pos, self.vel, self.age, self.life,
+                          self.gravity, self.size, self.look):
+                array[:len(keep)] = array[keep]
+            self.count = len(keep)
+
+    def Draw(self, screen, view):
+        """Blit the particles inside view (world coordinates), the upper-left
+           corner of view is drawn to the upper-left corner of the screen.
+           Return the rect covering the drawn particles, None if nothing was
+           drawn."""
+        count = self.count
+        if not count:
+            return None
+        pos = self.pos[:count]
+        size = self.size[:count]
+        visible = (pos[:, 0] < view.x + view.w) & (pos[:, 0] + size > view.x) & \
+                  (pos[:, 1] < view.y + view.h) & (pos[:, 1] + size > view.y)
+        screen_pos = (pos[visible] - (view.x, view.y)).astype(numpy.int32)
+        if not len(screen_pos):
+            return None
+        # Particles fade out in steps during their life
+        fade = (self.age[:count][visible] / self.life[:count][visible] *
+                particle_fade_levels).astype(numpy.int32)
+        look = self.look[:count][visible] + numpy.minimum(fade, particle_fade_levels - 1)
+
+        looks = self.looks
+        batch = [(looks[index], xy) for index, xy in
+                 zip(look.tolist(), screen_pos.tolist())]
+        # Surface.blits is available since pygame 1.9.4
+        if hasattr(screen, "blits"):
+            screen.blits(batch, False)
+        else:
+            for surface, xy in batch:
+                screen.blit(surface, xy)
+        self.stats["blits"] += len(batch)
+
+        low = screen_pos.min(axis=0)
+        high = screen_pos.max(axis=0) + size[visible].max()
+        return pygame.Rect(int(low[0]), int(low[1]),
+                           int(high[0] - low[0]), int(high[1] - low[1]))
+
+    def TakeStats(self):
+        """Return the work counters, and start counting again"""
+        stats = self.stats
+        self.stats = {"spawned": 0, "dropped": 0, "blits": 0}
+        return stats
+
+################################ CHECK LOAD TYPE ###############################
+
+if __name__ == "__main__":
+    print ("ENTITIES.PY should be imported as a library!!!")
@@ -15,12 +15,14 @@ Animation:
     calculate object movement
     blit all moving objects at their new position
     use display.update(rect_list_to_update) to refresh only changed parts of the screen
+    -> done by DirtyRenderer, F2 switches between dirty and full-screen rendering
 
 Physics:
     RK4 integrator
     fixed time-step
     inputs apply forces
     no inertia?
+    -> done by PhysicsBody and FixedTimestep, strong drag keeps the inertia low
 
 Options menu:
     Actual value change should be done only when exiting (destroying?) Optionsscene
@@ -39,16 +41,26 @@ if (A.x - B.x)*(A.x - B.x) + (A.y - B.y)*(A.y - B.y) < (A.r + B.r)*(A.r + B.r):
 
 TEST:
     Fix windowed menu position (for quitscene)
-    adjust bunny rect to be pixel-precise
-    check block rect and the gap between bunny and block
     include todo.txt here
 """
 
 import os
 import sys
+import time
+# Start of the slow imports, the first part of the startup time
+_import_start = time.perf_counter()
 import pygame
 from libfalcon import *
 
+try:
+    import entities
+except ImportError:
+    # NumPy is optional, the game runs without entities if it's missing
+    entities = None
+
+# Reported only by the first main() call of the process
+_import_time = time.perf_counter() - _import_start
+
 # Each menu consists of one or more headers for the given scene and one or more
 # items which are the possible "buttons" to select. Each item has a second
 # parameter which is the name of the function to be called when the given item
@@ -69,25 +81,79 @@ _active_res = 0
 _fullscreen = 0
 #
 _isplayingsound = False
+# Sound effects: name -> (file in sound_dir, priority, the fallback without
+# the file: a synthesized sweep (start frequency, end frequency, duration))
+_sound_effects = {
+    "hop":    ("hop.wav",    1, (300, 600, 0.08)),
+    "land":   ("land.wav",   0, (180, 90, 0.06)),
+    "pickup": ("pickup.wav", 2, (880, 1320, 0.15)),
+}
+# Redraw only the changed parts of the screen in GameScene, instead of a full
+# screen update in each frame
+_dirty_rendering = True
+# Length of one simulation step (sec) and the maximum number of steps to run
+# in one frame, when the rendering can't keep up
+_sim_step = 1.0 / 120
+_max_sim_steps = 10
+# The frame profiler is switched on and off with this key, recorded frames are
+# written to this file on exit
+_profiler_key = pygame.K_F3
+_profile_csv = "profile.csv"
+# Initialize only the used pygame subsystems, instead of pygame.init()
+_lazy_init = True
+# Print the startup timing breakdown when the first frame is shown
+_startup_report = False
+# Images of the sprites and their scaling (the look is 1/scaling of the screen
+# width). build_assets.py pre-scales them for each resolution
+_sprite_scalings = {"bunny_look.png": 16}
+# Pre-decoded images and fonts, made by make_bundle.py. Loose files are used
+# if it doesn't exist
+_asset_bundle = "assets.bundle"
+# Wait for events while the active scene is idle, instead of rendering the
+# same frame again (see SceneBase.idle)
+_idle_pacing = True
+# Frame pacing strategy of FramePacer: "tick", "busy" or "vsync"
+_pacing = "tick"
+# Print the frame interval jitter on exit
+_pacing_report = False
+# No automatic garbage collection during the gameplay, collect at the scene
+# transitions instead (see GcPolicy)
+_gc_policy = True
+# Print the garbage collection pauses and the peak memory on exit
+_gc_report = False
 
 class TitleScene(SceneBase, MenuBase):
+    cacheable = True
+    manifest = {"fonts": ((default_font, default_font_size),
+                          (default_font, default_header_font_size))}
+
     def __init__(self, screen, active_scene=None):
         SceneBase.__init__(self, screen,
             pygame.Rect(0, 0, screen.get_width(), screen.get_height()))
         MenuBase.__init__(self, screen, _title_headers, _title_items)
 
+        # Start loading the media of the scenes reachable from the menu, while
+        # the player is looking at the title
+        for name, action in _title_items:
+            scene = globals().get(action)
+            if isinstance(scene, type) and issubclass(scene, SceneBase):
+                asset_loader.Preload(scene.Manifest(screen))
+
     def ProcessInput(self, screen, events, pressed_keys):
         for event in events:
             if event.type == pygame.KEYDOWN:
                 return self.HandleKeyboard(screen, event.key)
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                return self.HandleMouse(event.button)
+                return self.HandleMouse(event.button, event.pos)
         return self.__class__.__name__
 
     def GenerateOutput(self, screen):
         self.BlitMenu(screen, color_lib["orange"])
 
 class QuitScene(SceneBase, MenuBase):
+    cacheable = True
+    manifest = {"fonts": ((default_font, 35), (default_font, 50))}
+
     def __init__(self, screen, active_scene=None):
         SceneBase.__init__(self, screen,
             pygame.Rect(0, 0, screen.get_width(), screen.get_height()))
@@ -99,7 +165,7 @@ class QuitScene(SceneBase, MenuBase):
             if event.type == pygame.KEYDOWN:
                 return self.HandleKeyboard(screen, event.key)
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                return self.HandleMouse(event.button)
+                return self.HandleMouse(event.button, event.pos)
         return self.__class__.__name__
 
     def GenerateOutput(self, screen):
@@ -113,9 +179,10 @@ def ChangeResolution(screen, active_scene):
     else:
         _active_res += 1
 
-    pygame.display.set_mode(_resolutions[_active_res],_fullscreen)
+    screen = set_display_mode()
+    invalidate_variants()
 
-    return OptionsScene(screen)
+    return scene_registry.Get(OptionsScene, screen)
 
 def ToggleFullscreen(screen, active_scene):
     global _fullscreen
@@ -125,9 +192,10 @@ def ToggleFullscreen(screen, active_scene):
     else:
         _fullscreen = 0
 
-    pygame.display.set_mode(_resolutions[_active_res],_fullscreen)
+    screen = set_display_mode()
+    invalidate_variants()
 
-    return OptionsScene(screen)
+    return scene_registry.Get(OptionsScene, screen)
 
 def ToggleSound(screen, active_scene):
     global _isplayingsound
@@ -136,13 +204,18 @@ def ToggleSound(screen, active_scene):
         _isplayingsound = True
     else:
         _isplayingsound = False
+    # The mixer is started only when the sound is first switched on
+    audio.SetEnabled(_isplayingsound)
 
-    return OptionsScene(screen)
+    return scene_registry.Get(OptionsScene, screen)
 
 def ChangeKeys(screen, active_scene):
-    return OptionsScene(screen)
+    return scene_registry.Get(OptionsScene, screen)
 
 class OptionsScene(SceneBase, MenuBase):
+    cacheable = True
+    manifest = {"fonts": ((default_font, 40), (default_font, default_header_font_size))}
+
     def __init__(self, screen, active_scene=None):
         SceneBase.__init__(self, screen,
             pygame.Rect(0, 0, screen.get_width(), screen.get_height()))
@@ -154,23 +227,47 @@ class OptionsScene(SceneBase, MenuBase):
             if event.type == pygame.KEYDOWN:
                 return self.HandleKeyboard(screen, event.key)
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                return self.HandleMouse(event.button)
+                return self.HandleMouse(event.button, event.pos)
         return self.__class__.__name__
 
     def GenerateOutput(self, screen):
         self.BlitMenu(screen, color_lib["forest"])
 
-class Bunny(SpriteBase):
+class Bunny(GameObject):
+    __slots__ = ("move_step", "jump_step", "gravity", "body", "move_force",
+                 "jump_force", "gravity_force", "prev_x", "prev_y",
+                 "facing_right", "looks", "masks", "moving_dir", "jumping")
+
     def __init__(self, look_image, scaling, posx, posy, screen):
-        SpriteBase.__init__(self, look_image, scaling, posx, posy, screen)
+        GameObject.__init__(self, look_image, scaling, posx, posy, screen)
 
         # Move 1/200 of the screen in each frame -> this is speed (pixel/frame)
         self.move_step = screen.get_width() // 180
         self.jump_step = screen.get_width() // 90
         self.gravity = screen.get_width() // 180
 
-        # Bunny should be facing right by default
+        # The speeds above were tuned for 60 frames/sec. The physics applies
+        # forces instead, which are chosen so, that the drag limits the bunny
+        # to the same speeds. High drag means it reaches them almost instantly
+        tuned_fps = 60
+        self.body = PhysicsBody(self.rect.x, self.rect.y, drag=20.0)
+        self.move_force = self.move_step * tuned_fps * self.body.drag * self.body.mass
+        self.jump_force = self.jump_step * tuned_fps * self.body.drag * self.body.mass
+        self.gravity_force = self.gravity * tuned_fps * self.body.drag * self.body.mass
+
+        # Position before the last simulation step, the bunny is drawn
+        # between this and the current one
+        self.prev_x = self.rect.x
+        self.prev_y = self.rect.y
+        self.draw_rect = self.rect.copy()
+
+        # Bunny should be facing right by default. Looks for both directions
+        # are prepared in advance, turning around only swaps them
         self.facing_right = True
+        self.looks = {True: self.look,
+                      False: load_variant(self.look_path, self.look_width, True, True)}
+        self.masks = {True: self.mask,
+                      False: load_mask(self.look_path, self.look_width, True, True)}
 
         # This will have only one of the values defined in "mov_lib"
         self.moving_dir = 0
@@ -195,68 +292,159 @@ class Bunny(SpriteBase):
         # then flip the bunny look, to face in the direction of the movement
         if (posx_delta < 0 and self.facing_right == True) or \
            (posx_delta > 0 and self.facing_right == False):
-            self.look = pygame.transform.flip(self.look, True, False)
             self.facing_right = not self.facing_right
-
-    def ForceBoundaries(self, screen):
-        """Keep the bunny on-screen, modify coordinates in case it would move outside"""
-        if self.rect.x < 0:
-            self.rect.x = 0
-        elif self.rect.x > screen.get_width() - self.rect.w:
-            self.rect.x = screen.get_width() - self.rect.w
-        if self.rect.y < 0:
-            self.rect.y = 0
-        elif self.rect.y > screen.get_height() - self.rect.h:
-            self.rect.y = screen.get_height() - self.rect.h
-
-class Ground(SpriteBase):
-    def __init__(self, look_image, scaling, posx, posy, screen):
-        SpriteBase.__init__(self, look_image, scaling, posx, posy, screen)
-
-class Block(SpriteBase):
-    def __init__(self, look_image, scaling, posx, posy, screen):
-        SpriteBase.__init__(self, look_image, scaling, posx, posy, screen)
+            self.look = self.looks[self.facing_right]
+            self.mask = self.masks[self.facing_right]
+
+    def ForceBoundaries(self, bounds):
+        """Keep the bunny inside bounds (the world), modify coordinates in case
+           it would move outside"""
+        if self.rect.x < bounds.x:
+            self.rect.x = bounds.x
+        elif self.rect.x > bounds.right - self.rect.w:
+            self.rect.x = bounds.right - self.rect.w
+        if self.rect.y < bounds.y:
+            self.rect.y = bounds.y
+        elif self.rect.y > bounds.bottom - self.rect.h:
+            self.rect.y = bounds.bottom - self.rect.h
+
+        # Stop the body on the axis where it was pushed back
+        if self.rect.x != round(self.body.posx):
+            self.StopBody(True, False)
+        if self.rect.y != round(self.body.posy):
+            self.StopBody(False, True)
+
+    def StopBody(self, axis_x, axis_y):
+        """Snap the physics body to the rect and cancel its velocity"""
+        if axis_x:
+            self.body.posx = float(self.rect.x)
+            self.body.velx = 0.0
+        if axis_y:
+            self.body.posy = float(self.rect.y)
+            self.body.vely = 0.0
+
+    def Interpolate(self, alpha):
+        """Move the drawn position between the last two simulation steps"""
+        self.draw_rect.x = round(self.prev_x + (self.rect.x - self.prev_x) * alpha)
+        self.draw_rect.y = round(self.prev_y + (self.rect.y - self.prev_y) * alpha)
 
 class GameScene(SceneBase):
+    mouse_visible = False
+    manual_gc = True
+    # Delay for sending the second KEYDOWN event when helding keys down, and the
+    # interval for sending all others. Both in msec
+    key_repeat = (50, 50)
+    level = os.path.join(level_dir, "level1.lvl")
+
+    @classmethod
+    def Manifest(cls, screen):
+        """The tiles of the level and the sprites, at the sizes load_variant
+           will use. Only the images without a bundled or prebuilt variant
+           are loaded, the others are never drawn at full size"""
+        tiles_per_screen, tile_defs, rows = Tilemap.Parse(cls.level)
+        tile_size = screen.get_width() // tiles_per_screen
+        variants = [(tile[0], tile_size, False) for tile in tile_defs.values()]
+        variants += [(os.path.join(image_dir, look), screen.get_width() // scaling, True)
+                     for look, scaling in _sprite_scalings.items()]
+        return {"images": tuple(path for path, width, trim in variants
+                                if not variant_ready(path, width, trim))}
+
     def __init__(self, screen, active_scene=None):
         SceneBase.__init__(self, screen,
             pygame.Rect(0, 0, screen.get_width(), screen.get_height()))
 
-        pygame.mouse.set_visible(False)
-
-        # Delay for sending the second KEYDOWN event when helding keys down, and the
-        # interval for sending all others. Both in msec
-        pygame.key.set_repeat(50,50)
-
-        # Create ground from small ground elements, which fill up the width of
-        # the whole screen
-        self.ground_list = []
-        self.ground_cnt = 10
-        # The x coordinate is increased after creating each ground element, so
-        # they will be next to each other
-        ground_x = 0
-        for i in range(self.ground_cnt):
-            self.ground_list.append(Ground("ground.png", self.ground_cnt,
-                                    ground_x, screen.get_height(), screen))
-            ground_x += self.ground_list[-1].rect.w
-
-        # Create a block
-        self.block = Block("block.png", 10, screen.get_width() // 2,
-                           self.ground_list[0].rect.y,
-                           screen)
+        # Media is probably preloaded by the title scene already, wait only
+        # for what is still in progress
+        manifest = self.Manifest(screen)
+        asset_loader.Preload(manifest)
+        asset_loader.Wait(manifest)
 
-        # Create a bunny
-        self.bunny = Bunny("bunny_look.png", 16, screen.get_width() // 20,
-                           self.ground_list[0].rect.y,
-                           screen)
+        # Load the level, its static tiles are rendered into chunks
+        self.tilemap = Tilemap(self.level, screen)
 
-        self.all_blocking = pygame.sprite.Group(self.ground_list, self.block)
+        # Create a bunny
+        self.bunny = Bunny("bunny_look.png", _sprite_scalings["bunny_look.png"],
+                           self.tilemap.spawn[0], self.tilemap.spawn[1], screen)
+
+        # Blocking areas are registered into a grid with tile sized cells,
+        # so collision checks only have to look at the nearby ones
+        self.all_blocking = BlockingGroup(self.tilemap.tile_size)
+        self.tilemap.AddBlocking(self.all_blocking.index)
+
+        # Enemies, projectiles and collectibles are updated in batches
+        self.entities = None
+        if entities != None:
+            self.entities = entities.EntityStore()
+            self.entities.SetBlocking(body.rect for body in self.tilemap.bodies)
+        # Falling acceleration of the entities (pixel/sec^2)
+        self.entity_gravity = screen.get_width() * 3
+
+        # Effects, dust when the bunny lands and a burst for each pickup
+        self.particles = None
+        # Screen area covered by the particles in the last frame
+        self.particle_rect = None
+        # Screen rects of the entities drawn in the last frame
+        self.entity_rects = []
+        if entities != None:
+            unit = screen.get_width() / 100.0
+            self.particles = entities.ParticleSystem(capacity=1024)
+            self.particles.AddEmitter("dust", entities.Emitter(
+                (color_lib["white"], color_lib["beige"]), size=max(2, int(unit / 2)),
+                burst=12, speed=(unit * 3, unit * 8), angle=(10, 170),
+                life=(0.2, 0.45), gravity=unit * 30, spread=(unit * 4, 0)))
+            self.particles.AddEmitter("pickup", entities.Emitter(
+                (color_lib["orange"], color_lib["yellow"]), size=max(2, int(unit / 2)),
+                burst=24, rate=60, duration=0.15, speed=(unit * 5, unit * 15),
+                life=(0.3, 0.6), gravity=unit * 20))
+
+        # The world is at least as big as the screen, the camera shows the
+        # part of it around the bunny
+        self.world = self.tilemap.rect.union(self.window)
+        self.camera = Camera(self.window, self.world)
+        self.camera.Snap(self.bunny.rect)
+
+        # Static objects are rendered only once into the background, only the
+        # moving sprites are blitted in each frame. The background is
+        # rendered again only when the camera moves
+        self.moving_sprites = (self.bunny,)
+        self.renderer = DirtyRenderer(self.window,
+                                      pygame.Surface(self.window.size).convert())
+        self.RenderBackground()
+
+        # Simulation runs with fixed steps, independently of the frame rate
+        self.timestep = FixedTimestep(_sim_step, _max_sim_steps)
+
+        # Everything above lives until the level is left, the collector
+        # doesn't have to look at it again
+        gc_policy.Freeze()
+
+    def Resume(self, screen):
+        SceneBase.Resume(self, screen)
+        # Time spent in other scenes must not be simulated, and the screen
+        # content is unknown
+        self.timestep.Reset()
+        self.renderer.Invalidate()
+
+    def Invalidate(self):
+        self.renderer.Invalidate()
+
+    def RenderBackground(self):
+        self.renderer.background.fill(color_lib["royalblue"])
+        profiler.Count("blits", self.tilemap.Draw(self.renderer.background,
+                                                  self.camera.rect))
+        self.background_view = self.camera.rect.topleft
+        self.renderer.Invalidate()
 
     def ProcessInput(self, screen, events, pressed_keys):
+        global _dirty_rendering
+
         for event in events:
             if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 # Move back to title scene when escape is pressed
                 return "TitleScene"
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F2:
+                # Switch between dirty rect and full screen rendering
+                _dirty_rendering = not _dirty_rendering
             elif event.type == pygame.KEYDOWN and event.key in key_lib_r:
                 self.bunny.SetMovingDirection(mov_lib[key_lib_r[event.key]],True)
             elif event.type == pygame.KEYUP and event.key in key_lib_r:
@@ -264,68 +452,122 @@ class GameScene(SceneBase):
 
         return self.__class__.__name__
 
-    def IsColliding(self, A):
-        for cur_sprite in self.all_blocking:
-            B = cur_sprite.rect
-            if (A.x < B.x + B.w) and (A.x + A.w > B.x) and \
-               (A.y < B.y + B.h) and (A.y + A.h > B.y):
-                return True
-        return False
-
-    def Update(self, screen):
-        # Update the position of the bunny based on the pressed keys
-        tmp = self.bunny.moving_dir
-        pow_2 = 0
-        while tmp:
-            if tmp % 2:
-                direction = 2 ** pow_2
-
-                # Short alias to rectangle of the bunny
-                A = self.bunny.rect
-                # Move the bunny in the desired direction only if there's no collision
-                if "left" == mov_lib_r[direction] and \
-                  not self.IsColliding(pygame.Rect(A.x-self.bunny.move_step,A.y,A.w,A.h)):
-                    self.bunny.UpdateCoordinates(-self.bunny.move_step,0)
-                elif "right" == mov_lib_r[direction] and \
-                  not self.IsColliding(pygame.Rect(A.x+self.bunny.move_step,A.y,A.w,A.h)):
-                    self.bunny.UpdateCoordinates(self.bunny.move_step,0)
-                elif "up" == mov_lib_r[direction]:
-                    self.bunny.jumping = True
-
-                    if not self.IsColliding(pygame.Rect(A.x,A.y-self.bunny.jump_step,A.w,A.h)):
-                        self.bunny.UpdateCoordinates(0,-self.bunny.jump_step)
-
-            pow_2 += 1
-            tmp = tmp // 2
-
-        # Short alias to rectangle of the bunny
-        A = self.bunny.rect
-        if self.IsColliding(pygame.Rect(A.x,A.y+self.bunny.gravity,A.w,A.h)):
-            self.bunny.jumping = False
-        else:
-            self.bunny.UpdateCoordinates(0, self.bunny.gravity)
+    def IsColliding(self, A, mask=None):
+        return self.all_blocking.index.IsColliding(A, mask)
+
+    def Update(self, screen, dt):
+        bunny = self.bunny
+        body = bunny.body
+        bunny.prev_x = bunny.rect.x
+        bunny.prev_y = bunny.rect.y
+
+        # Pressed keys and the gravity apply forces on the bunny
+        body.ClearForces()
+        body.ApplyForce(0, bunny.gravity_force)
+        if bunny.moving_dir & mov_lib["left"]:
+            body.ApplyForce(-bunny.move_force, 0)
+        if bunny.moving_dir & mov_lib["right"]:
+            body.ApplyForce(bunny.move_force, 0)
+        if bunny.moving_dir & mov_lib["up"]:
+            if not bunny.jumping:
+                audio.Play("hop")
+            bunny.jumping = True
+            body.ApplyForce(0, -bunny.jump_force)
+
+        body.Integrate(dt)
+
+        # Collisions are resolved on whole pixels, the body keeps the
+        # sub-pixel position. Move the bunny until its opaque pixels touch a
+        # blocking sprite, then slide along it
+        delta_x, delta_y, normal_x, normal_y = \
+            self.all_blocking.index.SweepMove(bunny.rect,
+                round(body.posx) - bunny.rect.x, round(body.posy) - bunny.rect.y,
+                bunny.mask)
+        bunny.UpdateCoordinates(delta_x, delta_y)
+        bunny.StopBody(normal_x != 0, normal_y != 0)
+
+        # Landed on top of something, raise some dust under the bunny
+        if normal_y < 0:
+            if bunny.jumping:
+                audio.Play("land")
+                if self.particles != None:
+                    self.particles.Start("dust", bunny.rect.centerx, bunny.rect.bottom)
+            bunny.jumping = False
 
         # Check the position on both axles
-        self.bunny.ForceBoundaries(screen)
+        bunny.ForceBoundaries(self.world)
+
+        if self.entities != None:
+            self.entities.Step(dt, self.entity_gravity)
+            # Collect the pickups touched by the bunny
+            for index in self.entities.Touching(bunny.rect, bunny.mask).tolist():
+                if self.entities.flags[index] & entities.PICKUP:
+                    self.entities.Despawn(index)
+                    audio.Play("pickup")
+                    self.particles.Start("pickup", *self.entities.pos[index].tolist())
+        if self.particles != None:
+            self.particles.Step(dt)
 
     def GenerateOutput(self, screen):
-        self.Update(screen)
-
-        screen.fill(color_lib["royalblue"], self.window)
-
-        for ground in self.ground_list:
-            screen.blit(ground.look, (ground.rect.x, ground.rect.y))
-            pygame.draw.rect(screen, color_lib["purple"], ground.rect, 1)
-
-        screen.blit(self.block.look, (self.block.rect.x, self.block.rect.y))
-        pygame.draw.rect(screen, color_lib["cyan"], self.block.rect, 1)
-
-        pygame.draw.rect(screen, color_lib["neon"], self.bunny.rect, 1)
-        screen.blit(self.bunny.look, (self.bunny.rect.x, self.bunny.rect.y))
-
-def main(fps):
-    pygame.init()
+        steps = self.timestep.Advance()
+        with profiler.Zone("update"):
+            for i in range(steps):
+                self.Update(screen, self.timestep.step)
+        self.Render(screen, steps * self.timestep.step, self.timestep.alpha)
+
+    def Render(self, screen, elapsed, alpha=1.0):
+        """Draw the simulated state, elapsed is the simulation time since the
+           last call, alpha is the interpolation between the last two steps"""
+        self.bunny.Interpolate(alpha)
+
+        # Scrolling changes the whole screen
+        self.camera.Follow(self.bunny.draw_rect, elapsed)
+        if self.camera.rect.topleft != self.background_view:
+            self.RenderBackground()
+
+        # In full screen mode the whole background is restored in each frame
+        if not _dirty_rendering:
+            self.renderer.Invalidate()
+
+        # Entities and particles are drawn over the sprites, their area of
+        # the last frame has to be restored
+        restore = list(self.entity_rects)
+        if self.particle_rect != None:
+            restore.append(self.particle_rect)
+        self.renderer.Draw(screen, self.moving_sprites, self.camera, restore)
+        self.entity_rects = []
+        if self.entities != None and self.entities.count > len(self.entities.free):
+            self.entity_rects = [rect.clip(self.window) for rect in
+                                 self.entities.Draw(screen, self.camera.rect)]
+            profiler.Count("blits", len(self.entity_rects))
+        if self.particles != None:
+            with profiler.Zone("particles"):
+                self.particle_rect = self.particles.Draw(screen, self.camera.rect)
+                if self.particle_rect != None:
+                    self.particle_rect = self.particle_rect.clip(self.window)
+            stats = self.particles.TakeStats()
+            profiler.Count("particles", self.particles.count)
+            profiler.Count("particles_dropped", stats["dropped"])
+            profiler.Count("blits", stats["blits"])
+        pygame.draw.rect(screen, color_lib["neon"],
+                         self.camera.ToScreen(self.bunny.draw_rect), 1)
+        profiler.Count("sprites", len(self.moving_sprites))
+        profiler.Count("fine_tests", self.all_blocking.index.fine_tests)
+        sound_stats = audio.TakeStats()
+        profiler.Count("sounds", sound_stats["played"])
+        profiler.Count("sounds_dropped", sound_stats["dropped"])
+        profiler.Count("gc", gc_policy.TakeStats())
+        self.all_blocking.index.fine_tests = 0
+        profiler.Count("blits", self.renderer.blit_count)
+
+        if _dirty_rendering:
+            self.dirty_rects = self.renderer.dirty_rects + self.entity_rects
+            if self.particle_rect != None:
+                self.dirty_rects = self.dirty_rects + [self.particle_rect]
+        else:
+            self.dirty_rects = None
 
+def set_cursor():
     # Create new cursor from 'cursor_string', where the hotspot is (23,0)
     cursor_string = (
         "            XXXX   XXXX ",
@@ -355,33 +597,153 @@ def main(fps):
     )
     cursor, mask = pygame.cursors.compile(cursor_string, 'X', '.', 'O')
     cursor_size = len(cursor_string[0]), len(cursor_string)
-    pygame.mouse.set_cursor(cursor_size, (0,23), cursor, mask)
+    try:
+        pygame.mouse.set_cursor(cursor_size, (0,23), cursor, mask)
+    except pygame.error:
+        # E.g. the dummy video driver of headless runs has no cursor support
+        pass
+
+def register_sounds():
+    """Register the effects of _sound_effects, they are decoded when the
+       sound is switched on"""
+    for name, (file_name, priority, sweep) in _sound_effects.items():
+        path = os.path.join(sound_dir, file_name)
+        if os.path.isfile(path):
+            audio.Register(name, path, priority)
+        else:
+            audio.Register(name, lambda sweep=sweep: synth_sound(*sweep), priority)
 
-    # Create graphical window
-    pygame.display.set_caption("Bunny hop")
+def set_icon():
     pygame.display.set_icon(load_image(os.path.join(image_dir,"bunny_256.png")))
-    screen = pygame.display.set_mode((_resolutions[_active_res][0],
-        _resolutions[_active_res][1]))
-
-    clock = pygame.time.Clock()
-    next_scene = TitleScene(screen)
 
+def set_display_mode():
+    """Create the window (or the screen) in the active mode. Vsync needs the
+       scaled display of pygame 2, without it the pacing falls back to tick"""
+    global _pacing
+
+    size = _resolutions[_active_res]
+    if _pacing == "vsync":
+        try:
+            return pygame.display.set_mode(size, _fullscreen | pygame.SCALED,
+                                           vsync=1)
+        except (AttributeError, TypeError, pygame.error):
+            _pacing = "tick"
+    return pygame.display.set_mode(size, _fullscreen)
+
+def main(fps, record=None, replay=None, replay_frame_time=None):
+    """Run the game. Input of the session can be recorded to a file, or
+       a recorded session can be replayed instead of the live input."""
+    global _active_res, _fullscreen, _import_time
+
+    startup = StartupTimer()
+    if _import_time != None:
+        startup.Add("imports", _import_time)
+        _import_time = None
+
+    replayer = None
+    if replay != None:
+        replayer = InputReplayer(replay, replay_frame_time)
+        # Replay starts with the same display mode as the recording
+        if replayer.resolution in _resolutions:
+            _active_res = _resolutions.index(replayer.resolution)
+        _fullscreen = pygame.FULLSCREEN if replayer.fullscreen else 0
+
+    if _lazy_init:
+        init_subsystems(_isplayingsound)
+    else:
+        preinit_mixer()
+        pygame.init()
+    register_sounds()
+    audio.SetEnabled(_isplayingsound)
+    open_bundle(_asset_bundle)
+    startup.Mark("init")
+
+    # Create graphical window. Decoding the icon and compiling the cursor
+    # can wait until the first frame is shown
+    pygame.display.set_caption("Bunny hop")
+    screen = set_display_mode()
+    startup.Defer(set_icon)
+    startup.Defer(set_cursor)
+    startup.Mark("display")
+
+    # Scenes of a previous run (e.g. in the same benchmark process) belong to
+    # a display surface which doesn't exist anymore
+    scene_registry.Clear()
+
+    recorder = None
+    if record != None:
+        recorder = InputRecorder(record, _resolutions[_active_res], _fullscreen)
+
+    pacer = FramePacer(_pacing)
+    gc_policy.enabled = _gc_policy
+    try:
+        scene_loop(screen, fps, pacer, recorder, replayer, startup)
+    finally:
+        gc_policy.Stop()
+        if _pacing_report:
+            print(pacer.Report())
+        if _gc_report:
+            print(gc_policy.Report())
+        if profiler.frames:
+            profiler.DumpCSV(_profile_csv)
+        if recorder != None:
+            recorder.Close()
+        if replayer != None:
+            replayer.Close()
+
+def scene_loop(screen, fps, pacer, recorder=None, replayer=None, startup=None):
+    next_scene = scene_registry.Get(TitleScene, screen)
+    gc_policy.Transition(next_scene)
+    if startup != None:
+        startup.Mark("first_scene")
+
+    idle_wait = False
     while True:
         active_scene = next_scene
+        # Nothing changed in the last frame: sleep until an event arrives,
+        # or the scene wants to wake up. The event which woke the loop up is
+        # the first one of the frame
+        woken = []
+        if idle_wait:
+            event = wait_event(active_scene.idle_timeout)
+            if event != None:
+                woken.append(event)
+            pacer.Reset()
+
+        profiler.BeginFrame()
         filtered_events = []
         pressed_keys = pygame.key.get_pressed()
 
-        # Process quit requests, collect all other requests
-        for event in pygame.event.get():
-            if (event.type == pygame.QUIT) or \
-               (event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and \
-                (pressed_keys[pygame.K_LALT] or pressed_keys[pygame.K_RALT])):
-                return
+        with profiler.Zone("input"):
+            # Replayed input replaces the live one, and it also drives the
+            # simulation clock. Quitting works with the live input anyway
+            if replayer != None:
+                replayed = replayer.Next(pressed_keys)
+                if replayed == None:
+                    return
             else:
-                filtered_events.append(event)
-
-        # Work on those inputs
-        action = active_scene.ProcessInput(screen, filtered_events, pressed_keys)
+                sim_clock.Tick()
+
+            # Process quit requests, collect all other requests
+            for event in woken + pygame.event.get():
+                if (event.type == pygame.QUIT) or \
+                   (event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and \
+                    (pressed_keys[pygame.K_LALT] or pressed_keys[pygame.K_RALT])):
+                    return
+                elif event.type == pygame.KEYDOWN and event.key == _profiler_key:
+                    profiler.Toggle()
+                    # The overlay has to be removed from the screen
+                    active_scene.Invalidate()
+                else:
+                    filtered_events.append(event)
+
+            if replayer != None:
+                filtered_events, pressed_keys = replayed
+            if recorder != None:
+                recorder.Record(filtered_events, pressed_keys, sim_clock.dt)
+
+            # Work on those inputs
+            action = active_scene.ProcessInput(screen, filtered_events, pressed_keys)
 
         # If the next scene name is empty string, then quit
         if action == "":
@@ -389,19 +751,91 @@ def main(fps):
 
         # Execute action, update next_scene and screen
         if action != active_scene.__class__.__name__:
-            next_scene = globals()[action](screen, active_scene)
-            screen = pygame.display.get_surface()
+            with profiler.Zone("transition"):
+                active_scene.Suspend()
+                target = globals()[action]
+                # Scenes are taken from the registry, other actions (e.g. the
+                # options) return the scene to continue with
+                if isinstance(target, type):
+                    next_scene = scene_registry.Get(target, screen, active_scene)
+                else:
+                    next_scene = target(screen, active_scene)
+                screen = pygame.display.get_surface()
+                gc_policy.Transition(next_scene)
 
         # Update active_scene for next iteration of the loop
         active_scene = next_scene
 
         # Update the logic and render new screen
-        active_scene.GenerateOutput(screen)
+        with profiler.Zone("output"):
+            active_scene.GenerateOutput(screen)
+        dirty_rects = active_scene.dirty_rects
+        overlay_rect = profiler.DrawOverlay(screen)
+        if overlay_rect != None and dirty_rects != None:
+            dirty_rects = dirty_rects + [overlay_rect]
 
         # Show newly rendered stuff to user and keep fps
-        pygame.display.flip()
-        clock.tick(fps)
+        with profiler.Zone("present"):
+            pixels_pushed = update_display(dirty_rects)
+        profiler.Count("pixels", pixels_pushed)
+
+        if startup != None and not startup.done:
+            startup.FirstFrame()
+            if _startup_report:
+                print("\n".join(startup.Report()))
+
+        # Finish background loaded media in the rest of the frame
+        with profiler.Zone("collect"):
+            asset_loader.Collect()
+        # An idle frame is followed by waiting for events instead. Replays
+        # and profiling run all frames
+        idle_wait = active_scene.idle and _idle_pacing and replayer == None \
+                    and not profiler.enabled
+        with profiler.Zone("tick"):
+            if not idle_wait:
+                pacer.Wait(fps, pixels_pushed > 0)
+        profiler.EndFrame()
 
 # Execute main function only after the whole script was parsed
 if __name__ == "__main__":
-    main(60)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bunny hop")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the input of the session to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay the input recorded to FILE")
+    parser.add_argument("--frame-time", type=float, metavar="SEC",
+                        help="simulated time of each replayed frame, instead "
+                             "of the recorded frame times")
+    parser.add_argument("--headless", action="store_true",
+                        help="no window and no fps limit (for replays)")
+    parser.add_argument("--full-init", action="store_true",
+                        help="initialize all pygame subsystems at startup")
+    parser.add_argument("--startup-times", action="store_true",
+                        help="print the startup timing breakdown")
+    parser.add_argument("--pacing", choices=FramePacer.strategies,
+                        default=_pacing, help="frame pacing strategy")
+    parser.add_argument("--pacing-report", action="store_true",
+                        help="print the frame interval jitter on exit")
+    parser.add_argument("--no-idle", action="store_true",
+                        help="render every frame, even if nothing changed")
+    parser.add_argument("--auto-gc", action="store_true",
+                        help="keep the automatic garbage collection in gameplay")
+    parser.add_argument("--gc-report", action="store_true",
+                        help="print the garbage collection pauses and the "
+                             "peak memory on exit")
+    args = parser.parse_args()
+
+    _lazy_init = not args.full_init
+    _startup_report = args.startup_times
+    _pacing = args.pacing
+    _pacing_report = args.pacing_report
+    _idle_pacing = not args.no_idle
+    _gc_policy = not args.auto_gc
+    _gc_report = args.gc_report
+
+    if args.headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+    main(0 if args.headless else 60, args.record, args.replay, args.frame_time)
@@ -8,22 +8,131 @@ Content:
 
 ################################### IMPORTS ####################################
 
+import io
 import os
+import gc
+import sys
+import math
+import mmap
+import array
+import time
+import collections
+import concurrent.futures
 import pygame
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is not reported there
+    resource = None
+
 ############################### UTILITY FUNCTIONS ##############################
 
 def inverse_dict(dict):
     return {dict[k] : k for k in dict}
 
+# Media libraries are indexed with lowercase paths, using native separators
+def normalize_path(path):
+    return path.lower().replace('/', os.sep).replace('\\', os.sep)
+
+def read_file(path):
+    with open(path, "rb") as media_file:
+        return media_file.read()
+
 # Calculate center from two inputs, returned value is minimum zero
 def get_center(max_size, act_size):
     return max((max_size // 2 - act_size // 2), 0)
 
+# Variable length encoding of non-negative integers, 7 bits in each byte
+def write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+# Returns the decoded integer and the position after it
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+# Map signed integers to non-negative ones (0, -1, 1, -2 -> 0, 1, 2, 3), so
+# small negative deltas are stored on few bytes too
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+# Swept AABB test of box A (given by coordinates, to avoid creating Rects)
+# moving with (vx, vy) during one frame against the static rect B.
+# Returns the entry time in [0, 1) and the surface normal of B at the contact
+# point, or None if A doesn't hit B during the movement
+def sweep_aabb(ax, ay, aw, ah, vx, vy, B):
+    inf = float("inf")
+
+    if vx > 0:
+        tx_entry = (B.x - (ax + aw)) / vx
+        tx_exit = (B.x + B.w - ax) / vx
+    elif vx < 0:
+        tx_entry = (B.x + B.w - ax) / vx
+        tx_exit = (B.x - (ax + aw)) / vx
+    elif ax < B.x + B.w and ax + aw > B.x:
+        tx_entry, tx_exit = -inf, inf
+    else:
+        return None
+
+    if vy > 0:
+        ty_entry = (B.y - (ay + ah)) / vy
+        ty_exit = (B.y + B.h - ay) / vy
+    elif vy < 0:
+        ty_entry = (B.y + B.h - ay) / vy
+        ty_exit = (B.y - (ay + ah)) / vy
+    elif ay < B.y + B.h and ay + ah > B.y:
+        ty_entry, ty_exit = -inf, inf
+    else:
+        return None
+
+    entry = max(tx_entry, ty_entry)
+    exit = min(tx_exit, ty_exit)
+    # Already overlapping (negative entry), moving away or not reaching B
+    if entry > exit or exit <= 0 or entry < 0 or entry >= 1:
+        return None
+
+    # Touching a corner exactly is treated as landing on top of B
+    if tx_entry > ty_entry:
+        return entry, (-1 if vx > 0 else 1), 0
+    return entry, 0, (-1 if vy > 0 else 1)
+
+# One RK4 step on one axis for a body, whose acceleration depends only on its
+# velocity: a(v) = force / mass - drag * v
+# Returns the new position and velocity
+def rk4_axis(pos, vel, force, mass, drag, dt):
+    def accel(v):
+        return force / mass - drag * v
+
+    k1_x, k1_v = vel, accel(vel)
+    k2_x, k2_v = vel + k1_v * dt / 2, accel(vel + k1_v * dt / 2)
+    k3_x, k3_v = vel + k2_v * dt / 2, accel(vel + k2_v * dt / 2)
+    k4_x, k4_v = vel + k3_v * dt, accel(vel + k3_v * dt)
+
+    pos += dt / 6 * (k1_x + 2 * k2_x + 2 * k3_x + k4_x)
+    vel += dt / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v)
+    return pos, vel
+
 ############################### SHARED LIBRARIES ###############################
 
 font_dir = "fonts"
 image_dir = "images"
+# Pre-scaled variants of the images, made by build_assets.py
+variant_dir = "variants"
+level_dir = "levels"
+sound_dir = "sounds"
 
 #http://www.psyclops.com/tools/rgb/
 color_lib = {
@@ -72,12 +181,90 @@ default_font = "fff_tusj.ttf"
 default_font_size = 50
 default_header_font_size = 72
 default_font_color = color_lib["black"]
+# Memory budget of rendered texts, in bytes of surface pixel data
+default_text_cache_size = 4 * 1024 * 1024
+# A small mixer buffer keeps the latency of the sound effects low (512 samples
+# are about 12 ms at 44.1 kHz), the default one is up to 4 times bigger
+default_mixer_frequency = 44100
+default_mixer_buffer = 512
+
+class SurfaceCache:
+    """Least recently used cache of surfaces with a memory budget.
+       The size of a surface is the size of its pixel data."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.surfaces = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def get(self, key, default=None):
+        surface = self.surfaces.get(key)
+        if surface == None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.surfaces.move_to_end(key)
+        return surface
+
+    def __setitem__(self, key, surface):
+        if key in self.surfaces:
+            self.bytes -= self.SurfaceSize(self.surfaces.pop(key))
+        self.surfaces[key] = surface
+        self.bytes += self.SurfaceSize(surface)
+        self.Evict()
+
+    def SurfaceSize(self, surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def SetBudget(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.Evict()
+
+    def Evict(self):
+        # The last added surface is kept, even if it alone exceeds the budget
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            key, surface = self.surfaces.popitem(last=False)
+            self.bytes -= self.SurfaceSize(surface)
+            self.evictions += 1
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+    def GetStats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": len(self.surfaces),
+                "bytes": self.bytes, "max_bytes": self.max_bytes}
 
 sound_lib = {}
 music_lib = {}
 image_lib = {}
+# Images converted to the pixel format of the display, valid only as long as
+# the display format is the same as converted_format
+converted_lib = {}
+converted_format = None
 font_lib = {}
-text_lib = {}
+# Rendered texts are used by menus and HUD alike, dynamic texts (score, timer)
+# would grow an unbounded cache for the whole session
+text_lib = SurfaceCache(default_text_cache_size)
+# Glyph atlases for each (font, size, color), used for frequently changing texts
+atlas_lib = {}
+# Characters rasterised into each atlas
+default_charset = "".join(chr(c) for c in range(32, 127))
+# Scaled and flipped variants of images, shared by all sprites
+variant_lib = {}
+variant_stats = {"hits": 0, "misses": 0}
+# Collision masks of the variants with the same keys, and of solid rects with
+# (None, width, height) keys
+mask_lib = {}
+# Pre-decoded images and fonts, opened by open_bundle. Everything missing from
+# it is loaded from the loose files
+asset_bundle = None
 
 mov_lib = {
     "stand": 0,
@@ -103,18 +290,56 @@ key_lib_r = inverse_dict(key_lib)
 class LibraryError(Exception):
     pass
 
+def init_subsystems(sound):
+    """Initialize only the pygame subsystems used by the game, pygame.init()
+       would start all of them (e.g. the mixer even if the sound is off)"""
+    pygame.display.init()
+    pygame.font.init()
+    if sound:
+        init_mixer()
+
+def preinit_mixer():
+    """Set the mixer parameters used by the next mixer init (also the one of
+       pygame.init)"""
+    pygame.mixer.pre_init(default_mixer_frequency, -16, 2, default_mixer_buffer)
+
+def init_mixer():
+    """Initialize the mixer when it's first needed, return False if there's
+       no audio device"""
+    if pygame.mixer.get_init():
+        return True
+    preinit_mixer()
+    try:
+        pygame.mixer.init()
+    except pygame.error:
+        return False
+    return True
+
 def load_media(path, library):
-    path = path.lower().replace('/', os.sep).replace('\\', os.sep)
+    path = normalize_path(path)
     media = library.get(path)
     if media == None:
+        if library is sound_lib:
+            init_mixer()
         try:
             if library is sound_lib:
+                # Sound effects are decoded into memory
                 media = pygame.mixer.Sound(path)
             elif library is music_lib:
-                media = pygame.mixer.music.load(path)
+                # Music is streamed from the file when it's played
+                if not os.path.isfile(path):
+                    raise pygame.error("No such file")
+                media = path
             elif library is image_lib:
-                # Load image and convert it to the same format as the display
-                media = pygame.image.load(path)
+                # Take the image from the bundle, or from the background
+                # loader if it was preloaded (waits only if decoding is still
+                # in progress)
+                if asset_bundle != None:
+                    media = asset_bundle.Image(path)
+                if media == None:
+                    media = asset_loader.TakeImage(path)
+                if media == None:
+                    media = pygame.image.load(path)
             else:
                 raise LibraryError("Unsupported library!")
         except pygame.error as message:
@@ -123,73 +348,627 @@ def load_media(path, library):
         # Cache media object
         library[path] = media
 
-    if library is sound_lib:
-        sound.play()
-        return None
-    elif library is music_lib:
-        pygame.mixer.music.play()
-        return None
-    elif library is image_lib:
-        # If we have already initialized a screen, convert the image to the
-        # actual screen pixel format (for faster blitting)
-        if pygame.display.get_surface() != None:
-            media = media.convert_alpha()
+    if library is sound_lib or library is music_lib:
         return media
+    elif library is image_lib:
+        return convert_image(path, media)
     else:
         raise LibraryError("Unsupported library!")
 
+def is_opaque(surface):
+    """True if the surface has no transparent or translucent pixels"""
+    if not surface.get_flags() & pygame.SRCALPHA:
+        return surface.get_colorkey() == None
+    # Only the pixels with full alpha are set in the mask
+    mask = pygame.mask.from_surface(surface, 254)
+    return mask.count() == surface.get_width() * surface.get_height()
+
+def convert_image(path, image):
+    """Convert the image to the actual screen pixel format (for faster blitting).
+       Conversion is done only once for each display format, opaque images
+       drop the alpha channel and use RLE acceleration."""
+    global converted_lib, converted_format
+    display = pygame.display.get_surface()
+    # Without an initialized screen there's nothing to convert to
+    if display == None:
+        return image
+
+    # Surfaces converted to the previous display format are useless now
+    display_format = (display.get_bitsize(), display.get_masks())
+    if display_format != converted_format:
+        converted_lib.clear()
+        converted_format = display_format
+
+    converted = converted_lib.get(path)
+    if converted == None:
+        converted = to_display_format(image, is_opaque(image))
+        converted_lib[path] = converted
+    return converted
+
+def to_display_format(image, opaque):
+    if opaque:
+        converted = image.convert()
+        converted.set_alpha(None, pygame.RLEACCEL)
+        return converted
+    return image.convert_alpha()
+
 def load_sound(path):
     return load_media(path, sound_lib)
 
 def load_music(path):
+    """Return the path to stream the music from, see AudioManager.PlayMusic"""
     return load_media(path, music_lib)
 
+def synth_sound(start_freq, end_freq, duration, volume=0.5):
+    """Return a fading sine sweep as a Sound, for effects without a sound
+       file. The mixer has to be initialized (with 16 bit samples)."""
+    frequency, size, channels = pygame.mixer.get_init()
+    count = int(frequency * duration)
+    samples = array.array("h")
+    phase = 0.0
+    for i in range(count):
+        ratio = i / count
+        phase += 2 * math.pi * (start_freq + (end_freq - start_freq) * ratio) / frequency
+        samples.extend([int(32767 * volume * (1 - ratio) * math.sin(phase))] * channels)
+    return pygame.mixer.Sound(buffer=samples.tobytes())
+
 def load_image(path):
     return load_media(path, image_lib)
 
+def scale_image(image, width, trim=False):
+    """Scale the image to the given width (the height keeps the aspect ratio).
+       With trim, the fully transparent rows and columns around it are cut
+       off after the scaling. Used both at runtime and by build_assets.py,
+       so pre-scaled and runtime scaled variants are the same."""
+    # Opaque images are scaled without alpha, as they are after the
+    # conversion in load_image. Otherwise smooth scaling could leave some
+    # translucent pixels on the edges
+    if image.get_flags() & pygame.SRCALPHA and is_opaque(image):
+        opaque = pygame.Surface(image.get_size(), 0, 24)
+        opaque.blit(image, (0, 0))
+        image = opaque
+    ratio = image.get_height() / image.get_width()
+    # Smooth scaling works only with 24 and 32 bit surfaces
+    if image.get_bitsize() >= 24:
+        scaled = pygame.transform.smoothscale(image, (width, int(ratio*width)))
+    else:
+        scaled = pygame.transform.scale(image, (width, int(ratio*width)))
+    if trim:
+        # Threshold 0 keeps every pixel which is not fully transparent
+        bounds = pygame.mask.from_surface(scaled, 0).get_bounding_rects()
+        if bounds:
+            area = bounds[0].unionall(bounds[1:])
+            if area.size != scaled.get_size():
+                scaled = scaled.subsurface(area).copy()
+    return scaled
+
+def variant_path(path, width, trim=False):
+    """File of a pre-scaled variant in variant_dir"""
+    name, extension = os.path.splitext(os.path.basename(normalize_path(path)))
+    return os.path.join(variant_dir, "{}_{}{}.png".format(name, width, "_t" if trim else ""))
+
+def load_prebuilt_variant(path, width, trim):
+    """Return the variant made by build_assets.py, None if it doesn't exist
+       or it's older than the image"""
+    prebuilt = variant_path(path, width, trim)
+    try:
+        if os.path.getmtime(prebuilt) < os.path.getmtime(path):
+            return None
+        return pygame.image.load(prebuilt)
+    except (OSError, pygame.error):
+        return None
+
+def load_variant(path, width, flip=False, trim=False):
+    """Return the image scaled to the given width (the height keeps the aspect
+       ratio), flipped horizontally if requested, trimmed to its opaque
+       pixels if requested (see scale_image). Each variant is created only
+       once and then shared, until invalidate_variants is called."""
+    global variant_lib, variant_stats
+    key = (path, width, flip, trim)
+    variant = variant_lib.get(key)
+    if variant != None:
+        variant_stats["hits"] += 1
+        return variant
+
+    variant_stats["misses"] += 1
+    if flip:
+        # Flip the already scaled variant, instead of scaling again
+        variant = pygame.transform.flip(load_variant(path, width, False, trim), True, False)
+        variant_lib[key] = variant
+        return variant
+
+    # Pre-scaled by make_bundle.py or build_assets.py, only the conversion
+    # is left. Otherwise scale it now
+    opaque = None
+    variant = None
+    if asset_bundle != None:
+        variant = asset_bundle.Variant(path, width, trim)
+        if variant != None:
+            opaque = asset_bundle.IsOpaque(path, width, trim)
+    if variant == None:
+        variant = load_prebuilt_variant(path, width, trim)
+    if variant != None:
+        if pygame.display.get_surface() != None:
+            if opaque == None:
+                opaque = is_opaque(variant)
+            variant = to_display_format(variant, opaque)
+    else:
+        variant = scale_image(load_image(path), width, trim)
+        if not variant.get_flags() & pygame.SRCALPHA:
+            variant.set_alpha(None, pygame.RLEACCEL)
+    variant_lib[key] = variant
+    return variant
+
+def variant_ready(path, width, trim=False):
+    """True if load_variant doesn't need the full size image, because the
+       variant is loaded already, bundled or prebuilt"""
+    if (path, width, False, trim) in variant_lib:
+        return True
+    if asset_bundle != None and asset_bundle.HasVariant(path, width, trim):
+        return True
+    try:
+        return os.path.getmtime(variant_path(path, width, trim)) >= \
+               os.path.getmtime(path)
+    except OSError:
+        return False
+
+def invalidate_variants():
+    """Drop all variants, e.g. after the display resolution has been changed"""
+    variant_lib.clear()
+    mask_lib.clear()
+
+def load_mask(path, width, flip=False, trim=False):
+    """Return the collision mask of the variant from load_variant, built only
+       once for each variant"""
+    global mask_lib
+    key = (path, width, flip, trim)
+    mask = mask_lib.get(key)
+    if mask == None:
+        mask = pygame.mask.from_surface(load_variant(path, width, flip, trim))
+        mask_lib[key] = mask
+    return mask
+
+def load_solid_mask(width, height):
+    """Return a mask with all bits set, for sprites without an own mask"""
+    global mask_lib
+    key = (None, width, height)
+    mask = mask_lib.get(key)
+    if mask == None:
+        # The fill argument of Mask is new in pygame 2
+        mask = pygame.mask.Mask((width, height))
+        mask.fill()
+        mask_lib[key] = mask
+    return mask
+
 def load_font(font, size):
     global font_lib
-    key = str(font) + '|' + str(size)
+    key = (font, size)
     font_object = font_lib.get(key, None)
     if font_object == None:
         try:
-            font_object = pygame.font.Font(font, size)
+            data = None
+            if asset_bundle != None:
+                data = asset_bundle.FontData(font)
+            if data != None:
+                font_object = pygame.font.Font(io.BytesIO(data), size)
+            else:
+                font_object = pygame.font.Font(font, size)
         except OSError:
             font_object = pygame.font.SysFont("", size)
             print("Font (",font,") not found! Using system default font.")
         font_lib[key] = font_object
     return font_object
 
+def update_display(rect_list=None):
+    """Show newly rendered stuff to the user, return the number of pushed pixels.
+       Without a rect list the whole display surface is flipped, with an
+       empty one nothing is done."""
+    if rect_list == []:
+        return 0
+    if rect_list == None:
+        pygame.display.flip()
+        return pygame.display.get_surface().get_width() * \
+               pygame.display.get_surface().get_height()
+    pygame.display.update(rect_list)
+    return sum(rect.w * rect.h for rect in rect_list)
+
 def load_text(text, font, size, color):
     global text_lib, font_dir
-    font = os.path.join(font_dir, font)
-    key = '|'.join(map(str, (font, size, color, text)))
+    # Color has to be hashable (e.g. the tuples from color_lib)
+    key = (font, size, color, text)
     font_rendered = text_lib.get(key, None)
     if font_rendered == None:
-        font_object = load_font(font, size)
+        font_object = load_font(os.path.join(font_dir, font), size)
         font_rendered = font_object.render(text, True, color)
         text_lib[key] = font_rendered
     return font_rendered
 
+def load_atlas(font, size, color):
+    global atlas_lib
+    key = (font, size, color)
+    atlas = atlas_lib.get(key)
+    if atlas == None:
+        atlas = GlyphAtlas(font, size, color)
+        atlas_lib[key] = atlas
+    return atlas
+
+class AssetLoader:
+    """Decode images and read font files on worker threads, before a scene
+       needs them. Results are moved into the shared libraries (and converted
+       to the display format) only on the main thread."""
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.executor = None
+        # Normalized image path -> future of the decoded surface
+        self.pending_images = collections.OrderedDict()
+        # (font path, size) -> future of the font file content
+        self.pending_fonts = collections.OrderedDict()
+
+    def Submit(self, function, *args):
+        # Threads are started only when there's something to preload
+        if self.executor == None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        return self.executor.submit(function, *args)
+
+    def Preload(self, manifest):
+        """Start loading the "images" and "fonts" ((font, size) pairs) of a
+           scene manifest, which are not loaded or pending yet"""
+        # Bundled media is ready to use without decoding
+        bundle = asset_bundle
+        for path in manifest.get("images", ()):
+            path = normalize_path(path)
+            if bundle != None and bundle.Has(path):
+                continue
+            if path not in image_lib and path not in self.pending_images:
+                self.pending_images[path] = self.Submit(pygame.image.load, path)
+        for font, size in manifest.get("fonts", ()):
+            key = (os.path.join(font_dir, font), size)
+            if bundle != None and bundle.Has(key[0]):
+                continue
+            if key not in font_lib and key not in self.pending_fonts:
+                self.pending_fonts[key] = self.Submit(read_file, key[0])
+
+    def TakeImage(self, path):
+        """Return the decoded image of a pending path, or None if it's not
+           pending. Blocks only if decoding hasn't finished yet."""
+        future = self.pending_images.pop(path, None)
+        if future == None:
+            return None
+        try:
+            return future.result()
+        except pygame.error as message:
+            print ("Cannot load media:", path)
+            raise SystemExit(message)
+
+    def TakeFont(self, key):
+        future = self.pending_fonts.pop(key, None)
+        if future == None:
+            return
+        try:
+            font_lib[key] = pygame.font.Font(io.BytesIO(future.result()), key[1])
+        except OSError:
+            # load_font falls back to the system font, when it's needed
+            pass
+
+    def Wait(self, manifest):
+        """Finish loading everything in the manifest, only the unfinished
+           work is waited for"""
+        for path in manifest.get("images", ()):
+            load_image(path)
+        for font, size in manifest.get("fonts", ()):
+            self.TakeFont((os.path.join(font_dir, font), size))
+
+    def Collect(self, max_items=1):
+        """Move finished work into the libraries, without blocking. Called
+           from the main loop, converting at most max_items per frame."""
+        for path, future in list(self.pending_images.items()):
+            if max_items <= 0:
+                return
+            if future.done():
+                load_image(path)
+                max_items -= 1
+        for key, future in list(self.pending_fonts.items()):
+            if max_items <= 0:
+                return
+            if future.done():
+                self.TakeFont(key)
+                max_items -= 1
+
+asset_loader = AssetLoader()
+
+def open_bundle(path):
+    """Use the asset bundle at path (made by make_bundle.py), return False if
+       it doesn't exist or it's unusable, then the loose files are used"""
+    global asset_bundle
+    if asset_bundle != None:
+        asset_bundle.Close()
+        asset_bundle = None
+    if not os.path.exists(path):
+        return False
+    try:
+        asset_bundle = AssetBundle(path)
+    except (OSError, ValueError, BundleError) as message:
+        print("Cannot open asset bundle:", path, message)
+        return False
+    return True
+
+class BundleError(Exception):
+    pass
+
+class AssetBundle:
+    """Archive of pre-decoded images (raw RGBA pixels), pre-scaled variants
+       and font files, memory-mapped and used without copying or decoding.
+       Layout after the header:
+           number of entries, then each entry: name (normalized path with
+           '/' separators), kind, variant width, image width and height,
+           opaque flag, modification time of the source (ms), offset from
+           the start of the data and size (varints, the name is prefixed
+           by its length)
+           the data of all entries
+       Entries older than their loose source file are ignored."""
+    magic = b"HKAB"
+    version = 1
+    kind_image = 0
+    kind_variant = 1
+    kind_font = 2
+    kind_trimmed_variant = 3
+
+    def __init__(self, path):
+        self.bundle_file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.bundle_file.close()
+            raise
+        self.view = memoryview(self.data)
+        # (normalized path, kind, variant width or 0) -> entry tuple
+        self.entries = {}
+        # Paths checked against the loose files -> True if the entry is fresh
+        self.fresh = {}
+        self.ReadIndex()
+
+    def ReadIndex(self):
+        data = self.data
+        if data[:len(self.magic)] != self.magic or data[len(self.magic)] != self.version:
+            raise BundleError("Not a version {} asset bundle".format(self.version))
+        pos = len(self.magic) + 1
+        count, pos = read_varint(data, pos)
+        entries = []
+        for i in range(count):
+            length, pos = read_varint(data, pos)
+            name = normalize_path(bytes(data[pos:pos + length]).decode("utf-8"))
+            pos += length
+            values = []
+            for field in range(8):
+                value, pos = read_varint(data, pos)
+                values.append(value)
+            entries.append((name, values))
+        # Data offsets are relative to the end of the index
+        for name, values in entries:
+            kind, variant_width, width, height, opaque, mtime, offset, size = values
+            if pos + offset + size > len(data):
+                raise BundleError("Truncated asset bundle")
+            self.entries[(name, kind, variant_width)] = (kind, width, height, opaque != 0,
+                                                         mtime, pos + offset, size)
+
+    def IsFresh(self, path, mtime):
+        """False if the loose file was changed after the bundle was made.
+           Without the loose file (e.g. shipped only in the bundle) the
+           entry is used."""
+        fresh = self.fresh.get(path)
+        if fresh == None:
+            try:
+                fresh = int(os.path.getmtime(path) * 1000) <= mtime
+            except OSError:
+                fresh = True
+            self.fresh[path] = fresh
+        return fresh
+
+    def Entry(self, path, kind, variant_width=0):
+        entry = self.entries.get((path, kind, variant_width))
+        if entry == None or not self.IsFresh(path, entry[4]):
+            return None
+        return entry
+
+    def VariantKind(self, trim):
+        return self.kind_trimmed_variant if trim else self.kind_variant
+
+    def Has(self, path):
+        """True if the image or the font file is in the bundle"""
+        path = normalize_path(path)
+        return self.Entry(path, self.kind_image) != None or \
+               self.Entry(path, self.kind_font) != None
+
+    def IsOpaque(self, path, width, trim=False):
+        entry = self.Entry(normalize_path(path), self.VariantKind(trim), width)
+        return entry != None and entry[3]
+
+    def Surface(self, entry):
+        kind, width, height, opaque, mtime, offset, size = entry
+        # The surface uses the mapped memory directly
+        return pygame.image.frombuffer(self.view[offset:offset + size],
+                                       (width, height), "RGBA")
+
+    def Image(self, path):
+        """Return the original size image, None if it's not in the bundle"""
+        entry = self.Entry(normalize_path(path), self.kind_image)
+        if entry == None:
+            return None
+        return self.Surface(entry)
+
+    def HasVariant(self, path, width, trim=False):
+        return self.Entry(normalize_path(path), self.VariantKind(trim), width) != None
+
+    def Variant(self, path, width, trim=False):
+        """Return the image scaled to width, None if it's not in the bundle"""
+        entry = self.Entry(normalize_path(path), self.VariantKind(trim), width)
+        if entry == None:
+            return None
+        return self.Surface(entry)
+
+    def FontData(self, path):
+        """Return the content of a font file, None if it's not in the bundle"""
+        entry = self.Entry(normalize_path(path), self.kind_font)
+        if entry == None:
+            return None
+        offset, size = entry[5], entry[6]
+        return self.view[offset:offset + size]
+
+    def Close(self):
+        # Surfaces made from the bundle still refer to the mapped memory,
+        # the map itself is released with the last of them
+        self.view = None
+        self.bundle_file.close()
+
+    @classmethod
+    def Write(cls, path, images, variants, fonts):
+        """Write a bundle from the given sources:
+               images:   {image path: surface}
+               variants: {(image path, width, trim): surface}
+               fonts:    {font path: file content}"""
+        def mtime(source):
+            try:
+                return int(os.path.getmtime(source) * 1000)
+            except OSError:
+                return 0
+
+        items = []
+        for source, image in sorted(images.items()):
+            items.append((source, cls.kind_image, 0, image))
+        for (source, width, trim), image in sorted(variants.items()):
+            kind = cls.kind_trimmed_variant if trim else cls.kind_variant
+            items.append((source, kind, width, image))
+        for source, content in sorted(fonts.items()):
+            items.append((source, cls.kind_font, 0, content))
+
+        index = bytearray(cls.magic)
+        index.append(cls.version)
+        write_varint(index, len(items))
+        blobs = []
+        offset = 0
+        for source, kind, variant_width, content in items:
+            if kind == cls.kind_font:
+                blob = bytes(content)
+                width = height = 0
+                opaque = 0
+            else:
+                blob = pygame.image.tostring(content, "RGBA")
+                width, height = content.get_size()
+                opaque = 1 if is_opaque(content) else 0
+            name = normalize_path(source).replace(os.sep, "/").encode("utf-8")
+            write_varint(index, len(name))
+            index += name
+            for value in (kind, variant_width, width, height, opaque,
+                          mtime(source), offset, len(blob)):
+                write_varint(index, value)
+            blobs.append(blob)
+            offset += len(blob)
+
+        with open(path, "wb") as bundle_file:
+            bundle_file.write(index)
+            for blob in blobs:
+                bundle_file.write(blob)
+
 ################################ CLASS TEMPLATES ###############################
 
+class GlyphAtlas:
+    """All glyphs of a font rendered once into one surface. Strings are drawn
+       by blitting the glyphs one after the other (without kerning), so the
+       cost doesn't depend on how often the text changes."""
+    def __init__(self, font, size, color, charset=default_charset, max_width=1024):
+        font_object = load_font(os.path.join(font_dir, font), size)
+        rendered = [(char, font_object.render(char, True, color)) for char in charset]
+        self.height = max(glyph.get_height() for char, glyph in rendered)
+
+        # Place the glyphs in rows, each row is at most max_width wide
+        positions = []
+        posx = posy = 0
+        width = 0
+        for char, glyph in rendered:
+            if posx + glyph.get_width() > max_width and posx > 0:
+                posx = 0
+                posy += self.height
+            positions.append((posx, posy))
+            posx += glyph.get_width()
+            width = max(width, posx)
+
+        self.surface = pygame.Surface((max(width, 1), posy + self.height),
+                                      pygame.SRCALPHA, 32)
+        self.surface.fill((0, 0, 0, 0))
+        self.glyphs = {}
+        for (char, glyph), pos in zip(rendered, positions):
+            # Copy the glyph pixels as they are, blending them onto the
+            # transparent atlas would darken the antialiased edges
+            self.surface.blit(glyph, pos, special_flags=pygame.BLEND_RGBA_MAX)
+            self.glyphs[char] = pygame.Rect(pos, glyph.get_size())
+        if pygame.display.get_surface() != None:
+            self.surface = self.surface.convert_alpha()
+
+        # Glyphs are referenced as subsurfaces of the atlas
+        self.glyphs = {char: self.surface.subsurface(rect)
+                       for char, rect in self.glyphs.items()}
+        # Characters missing from the charset are drawn as this one
+        self.missing = self.glyphs.get("?", next(iter(self.glyphs.values())))
+
+    def Size(self, text):
+        glyphs = self.glyphs
+        return (sum(glyphs.get(char, self.missing).get_width() for char in text),
+                self.height)
+
+    def Draw(self, screen, text, pos):
+        """Blit the text to screen at pos, return its rect"""
+        posx, posy = pos
+        batch = []
+        for char in text:
+            glyph = self.glyphs.get(char, self.missing)
+            batch.append((glyph, (posx, posy)))
+            posx += glyph.get_width()
+        # Surface.blits is available since pygame 1.9.4
+        if hasattr(screen, "blits"):
+            screen.blits(batch, False)
+        else:
+            for glyph, glyph_pos in batch:
+                screen.blit(glyph, glyph_pos)
+        return pygame.Rect(pos[0], pos[1], posx - pos[0], self.height)
+
 class MenuElem:
     def __init__(self, name, font=default_font, font_size=default_font_size,
-                 font_color=default_font_color, action=""):
+                 font_color=default_font_color, action="", use_atlas=False):
 
-        self.name = name
         self.font = font
         self.font_size = font_size
         self.font_color = font_color
         self.action = action
 
-        self.text = load_text(name, self.font, self.font_size, self.font_color)
+        # Texts which change often (e.g. HUD counters) are drawn glyph by glyph
+        # from an atlas, instead of rendering and caching each string
+        if use_atlas:
+            self.atlas = load_atlas(self.font, self.font_size, self.font_color)
+        else:
+            self.atlas = None
 
-        self.width = self.text.get_width()
-        self.height = self.text.get_height()
+        self.SetText(name)
         self.posx = 0
         self.posy = 0
 
+    def SetText(self, name):
+        self.name = name
+        if self.atlas != None:
+            self.text = None
+            self.width, self.height = self.atlas.Size(name)
+        else:
+            self.text = load_text(name, self.font, self.font_size, self.font_color)
+            self.width = self.text.get_width()
+            self.height = self.text.get_height()
+
+    def Draw(self, screen, origin=(0, 0)):
+        """Blit the text to its position, relative to origin of the screen"""
+        pos = (self.posx - origin[0], self.posy - origin[1])
+        if self.atlas != None:
+            self.atlas.Draw(screen, self.name, pos)
+        else:
+            screen.blit(self.text, pos)
+
     def SetPos(self, posx, posy):
         self.posx = posx
         self.posy = posy
@@ -214,6 +993,11 @@ class MenuBase:
         self.items = []
         self.cur_item = None
         self.cur_rect = None
+        # The background and the labels are rendered only once into this
+        self.menu_surface = None
+        self.menu_color = None
+        # Selection rect at the time the menu was last blitted to the screen
+        self.shown_rect = None
 
         # For the aesthetical layout, we add a spacing before the headers
         # and between the menu options as well
@@ -270,14 +1054,39 @@ class MenuBase:
             # Store
             self.items.append(label)
 
-    def BlitMenu(self, screen, background_color):
-        screen.fill(background_color, self.window)
+    def RenderMenu(self, background_color):
+        self.menu_surface = pygame.Surface(self.window.size).convert()
+        self.menu_surface.fill(background_color)
         for label in self.headers:
-            screen.blit(label.text, (label.posx, label.posy))
+            label.Draw(self.menu_surface, self.window.topleft)
         for label in self.items:
-            screen.blit(label.text, (label.posx, label.posy))
+            label.Draw(self.menu_surface, self.window.topleft)
+        self.menu_color = background_color
+
+    def InvalidateMenu(self):
+        """Render the menu again next time, e.g. after a label was changed"""
+        self.menu_surface = None
+
+    def BlitMenu(self, screen, background_color):
+        """Blit the menu, unless the screen shows it already (see drawn of
+           SceneBase). Sets idle and dirty_rects of the scene: a menu without
+           input doesn't change, so the main loop can wait for events.
+           Return True if it was blitted."""
+        if self.menu_surface == None or self.menu_color != background_color:
+            self.RenderMenu(background_color)
+            self.drawn = False
+        if self.drawn and self.shown_rect == self.cur_rect:
+            self.idle = True
+            self.dirty_rects = []
+            return False
+        screen.blit(self.menu_surface, self.window)
         if self.cur_rect != None:
             pygame.draw.rect(screen, color_lib["black"], self.cur_rect, 1)
+        self.shown_rect = self.cur_rect
+        self.drawn = True
+        self.idle = False
+        self.dirty_rects = None
+        return True
 
     def HandleKeyboard(self, screen, key):
         if key == pygame.K_ESCAPE:
@@ -305,27 +1114,32 @@ class MenuBase:
 
         return self.__class__.__name__
 
-    def HandleMouse(self, button):
+    def HandleMouse(self, button, mouse_pos=None):
         if button == 1:
-            mouse_pos = pygame.mouse.get_pos()
+            if mouse_pos == None:
+                mouse_pos = pygame.mouse.get_pos()
             for label in self.items:
                 if label.IsMouseHovered(mouse_pos):
                     return label.action
 
         return self.__class__.__name__
 
-class SpriteBase(pygame.sprite.Sprite):
-    def __init__(self, look_image, scaling, posx, posy, screen):
-        pygame.sprite.Sprite.__init__(self)
-
-        # Load image to get a fancy look
-        self.look = load_image(os.path.join(image_dir, look_image))
+class GameObject:
+    """Lightweight base of the game objects: attributes are in __slots__, so
+       there is no instance dict, and no sprite group bookkeeping. Derived
+       classes list their own attributes in __slots__ too. Use SpriteBase
+       for objects which have to be members of pygame sprite groups."""
+    __slots__ = ("look_path", "look_width", "look", "mask", "rect", "draw_rect",
+                 "__weakref__")
 
-        # Scale the look depending on the display resolution
-        ratio = self.look.get_height() / self.look.get_width()
-        scaled_width = screen.get_width() // scaling
-        self.look = pygame.transform.smoothscale(self.look,
-                    (scaled_width, int(ratio*scaled_width)))
+    def __init__(self, look_image, scaling, posx, posy, screen):
+        # Load image to get a fancy look, scaled depending on the display
+        # resolution. Sprites with the same image share the scaled surface
+        self.look_path = os.path.join(image_dir, look_image)
+        self.look_width = screen.get_width() // scaling
+        # Transparent borders are trimmed, the rect covers only the look
+        self.look = load_variant(self.look_path, self.look_width, trim=True)
+        self.mask = load_mask(self.look_path, self.look_width, trim=True)
 
         # Get rect!
         # The stored posy (upper-left corner) is derived from the input argument
@@ -335,11 +1149,1119 @@ class SpriteBase(pygame.sprite.Sprite):
         self.rect = pygame.Rect(posx, posy-self.look.get_height(),
                     self.look.get_width(), self.look.get_height())
 
+        # Position where the sprite is drawn. It is the same as rect, unless
+        # the sprite is drawn interpolated between two simulation steps
+        self.draw_rect = self.rect
+
+class SpriteBase(GameObject, pygame.sprite.Sprite):
+    def __init__(self, look_image, scaling, posx, posy, screen):
+        pygame.sprite.Sprite.__init__(self)
+        GameObject.__init__(self, look_image, scaling, posx, posy, screen)
+
+class SpatialHash:
+    """Uniform grid broadphase, stores sprites in every cell their rect touches"""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # Cell coordinates -> set of sprites overlapping the given cell
+        self.cells = {}
+        # Sprite -> (rect at insertion time, range of the occupied cells)
+        self.bodies = {}
+        # Sprites which can move, their rects are checked in UpdateMoving
+        self.moving = set()
+        # Number of mask checks, which run only when the rects collide
+        self.fine_tests = 0
+        # Reused by the moves instead of new rects in every step
+        self.path = pygame.Rect(0, 0, 0, 0)
+        self.probe = pygame.Rect(0, 0, 0, 0)
+
+    def CellRange(self, rect):
+        """Return the first and last cell coordinates covered by rect"""
+        size = self.cell_size
+        return (rect.x // size, rect.y // size,
+                (rect.x + max(rect.w, 1) - 1) // size,
+                (rect.y + max(rect.h, 1) - 1) // size)
+
+    def Insert(self, sprite, moving=False):
+        if sprite in self.bodies:
+            self.Remove(sprite)
+        cell_range = self.CellRange(sprite.rect)
+        x1, y1, x2, y2 = cell_range
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                self.cells.setdefault((cx, cy), set()).add(sprite)
+        self.bodies[sprite] = (sprite.rect.copy(), cell_range)
+        if moving:
+            self.moving.add(sprite)
+
+    def Remove(self, sprite):
+        body = self.bodies.pop(sprite, None)
+        if body == None:
+            return
+        x1, y1, x2, y2 = body[1]
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                cell = self.cells[(cx, cy)]
+                cell.discard(sprite)
+                if not cell:
+                    del self.cells[(cx, cy)]
+        self.moving.discard(sprite)
+
+    def Move(self, sprite):
+        """Update the cells of a sprite after its rect has been changed"""
+        old_rect, old_range = self.bodies[sprite]
+        if old_rect == sprite.rect:
+            return
+        new_range = self.CellRange(sprite.rect)
+        # Moving inside the same cells doesn't require touching the grid
+        if new_range != old_range:
+            self.Insert(sprite, sprite in self.moving)
+        else:
+            self.bodies[sprite] = (sprite.rect.copy(), old_range)
+
+    def UpdateMoving(self):
+        for sprite in self.moving:
+            self.Move(sprite)
+
+    def QueryRect(self, rect):
+        """Return the set of sprites colliding with rect"""
+        found = set()
+        x1, y1, x2, y2 = self.CellRange(rect)
+        cells = self.cells
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                cell = cells.get((cx, cy))
+                if cell:
+                    found.update(s for s in cell if rect.colliderect(s.rect))
+        return found
+
+    def QueryPoint(self, posx, posy):
+        """Return the set of sprites containing the given point"""
+        size = self.cell_size
+        cell = self.cells.get((posx // size, posy // size), ())
+        return {s for s in cell if s.rect.collidepoint(posx, posy)}
+
+    def Sweep(self, posx, posy, width, height, vx, vy):
+        """Return the earliest contact time and normal of a box moving with
+           (vx, vy), only checking the cells covered by the whole movement.
+           Time is 1 and normal is (0, 0) if nothing is hit."""
+        size = self.cell_size
+        x1 = min(posx, posx + vx) // size
+        y1 = min(posy, posy + vy) // size
+        x2 = (max(posx, posx + vx) + max(width, 1) - 1) // size
+        y2 = (max(posy, posy + vy) + max(height, 1) - 1) // size
+        cells = self.cells
+        first = (1, 0, 0)
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                for sprite in cells.get((cx, cy), ()):
+                    hit = sweep_aabb(posx, posy, width, height, vx, vy, sprite.rect)
+                    if hit != None and hit[0] < first[0]:
+                        first = hit
+        return first
+
+    def SweepMove(self, rect, vx, vy, mask=None):
+        """Move rect with (vx, vy) and slide along the surfaces which are hit.
+           Return the possible displacement and the normals of the hit
+           surfaces on both axes, rect itself is not modified.
+           With a mask, only the opaque pixels block: if the rects of the
+           whole movement touch something, it is done by MaskMove."""
+        if mask != None:
+            path = self.path
+            path.x = min(rect.x, rect.x + vx)
+            path.y = min(rect.y, rect.y + vy)
+            path.w = rect.w + abs(vx)
+            path.h = rect.h + abs(vy)
+            if self.IsColliding(path):
+                return self.MaskMove(rect, mask, vx, vy)
+            return vx, vy, 0, 0
+
+        posx, posy = rect.x, rect.y
+        hit_x = hit_y = 0
+        # The first contact stops the movement on one axis, the remaining
+        # movement on the other axis needs one more sweep at most
+        for i in range(2):
+            if vx == 0 and vy == 0:
+                break
+            t, nx, ny = self.Sweep(posx, posy, rect.w, rect.h, vx, vy)
+            if t >= 1:
+                posx += vx
+                posy += vy
+                break
+            # Move exactly to the contact point on the blocked axis, and
+            # never further than the contact time allows on the other one
+            if nx:
+                move_x, move_y = round(vx * t), int(vy * t)
+                hit_x = nx
+                vx, vy = 0, vy - move_y
+            else:
+                move_x, move_y = int(vx * t), round(vy * t)
+                hit_y = ny
+                vx, vy = vx - move_x, 0
+            posx += move_x
+            posy += move_y
+        return posx - rect.x, posy - rect.y, hit_x, hit_y
+
+    def IsColliding(self, rect, mask=None):
+        """Same as QueryRect, but stops at the first colliding sprite.
+           With a mask (the look of the thing at rect), the rects are only
+           the first check, the masks have to overlap as well. Sprites
+           without a mask attribute are solid."""
+        x1, y1, x2, y2 = self.CellRange(rect)
+        cells = self.cells
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                for sprite in cells.get((cx, cy), ()):
+                    if rect.colliderect(sprite.rect):
+                        if mask == None:
+                            return True
+                        self.fine_tests += 1
+                        if mask.overlap(self.SpriteMask(sprite), (
+                                sprite.rect.x - rect.x, sprite.rect.y - rect.y)):
+                            return True
+        return False
+
+    def OverlapArea(self, rect, mask):
+        """Number of the overlapping mask pixels with all sprites at rect"""
+        area = 0
+        for sprite in self.QueryRect(rect):
+            self.fine_tests += 1
+            area += mask.overlap_area(self.SpriteMask(sprite), (
+                sprite.rect.x - rect.x, sprite.rect.y - rect.y))
+        return area
+
+    def SpriteMask(self, sprite):
+        mask = getattr(sprite, "mask", None)
+        if mask == None:
+            mask = load_solid_mask(sprite.rect.w, sprite.rect.h)
+        return mask
+
+    def MaskMove(self, rect, mask, vx, vy):
+        """Pixel-precise version of SweepMove, moving the mask one pixel at a
+           time, first on x then on y. A step is blocked if the masks would
+           overlap more than before it, so an overlapping start position
+           (e.g. after changing the look) doesn't get stuck."""
+        posx, posy = rect.x, rect.y
+        hit_x = hit_y = 0
+        overlap = self.OverlapArea(rect, mask)
+        probe = self.probe
+        probe.x, probe.y, probe.w, probe.h = rect.x, rect.y, rect.w, rect.h
+        for axis, distance in ((0, vx), (1, vy)):
+            step = 1 if distance > 0 else -1
+            for i in range(abs(distance)):
+                if axis == 0:
+                    probe.x = posx + step
+                else:
+                    probe.y = posy + step
+                moved = self.OverlapArea(probe, mask)
+                if moved > overlap:
+                    if axis == 0:
+                        probe.x = posx
+                        hit_x = -step
+                    else:
+                        probe.y = posy
+                        hit_y = -step
+                    break
+                overlap = moved
+                posx, posy = probe.x, probe.y
+        return posx - rect.x, posy - rect.y, hit_x, hit_y
+
+class BlockingGroup(pygame.sprite.Group):
+    """Sprite group which registers its members into a SpatialHash"""
+    def __init__(self, cell_size, *sprites):
+        self.index = SpatialHash(cell_size)
+        pygame.sprite.Group.__init__(self, *sprites)
+
+    def add_internal(self, sprite, *args):
+        pygame.sprite.Group.add_internal(self, sprite, *args)
+        self.index.Insert(sprite)
+
+    def remove_internal(self, sprite):
+        pygame.sprite.Group.remove_internal(self, sprite)
+        self.index.Remove(sprite)
+
+    def AddMoving(self, *sprites):
+        """Add sprites whose position is refreshed in the index by UpdateMoving"""
+        self.add(*sprites)
+        for sprite in sprites:
+            self.index.Insert(sprite, moving=True)
+
+    def UpdateMoving(self):
+        self.index.UpdateMoving()
+
+class GcPolicy:
+    """Keeps garbage collection pauses out of the gameplay. Objects of a
+       loaded level are frozen (moved out of the collected generations),
+       the automatic collection is off while a scene with manual_gc runs,
+       and the garbage is collected at the scene transitions instead.
+       The collections, their pauses and the peak memory are recorded,
+       with or without the policy."""
+    def __init__(self):
+        self.enabled = False
+        self.start = None
+        # Set while the policy itself collects
+        self.collecting = False
+        self.ResetStats()
+        gc.callbacks.append(self.Callback)
+
+    def ResetStats(self):
+        # Automatic collections, their total and longest pause (sec)
+        self.collections = 0
+        self.pause = 0.0
+        self.max_pause = 0.0
+        # Collections of the policy, at level loads and scene transitions
+        self.manual_collections = 0
+        self.manual_pause = 0.0
+        # Automatic collections since the last TakeStats
+        self.recent = 0
+
+    def Callback(self, phase, info):
+        if phase == "start":
+            self.start = time.perf_counter()
+        elif self.start != None:
+            pause = time.perf_counter() - self.start
+            self.start = None
+            if self.collecting:
+                self.manual_collections += 1
+                self.manual_pause += pause
+            else:
+                self.collections += 1
+                self.recent += 1
+                self.pause += pause
+                self.max_pause = max(self.max_pause, pause)
+
+    def Collect(self):
+        self.collecting = True
+        try:
+            gc.collect()
+        finally:
+            self.collecting = False
+
+    def Freeze(self):
+        """Call after loading a level. The objects of the previous level are
+           released first, they were frozen too"""
+        if self.enabled and hasattr(gc, "freeze"):
+            gc.unfreeze()
+            self.Collect()
+            gc.freeze()
+
+    def Transition(self, scene):
+        """Call when scene becomes the active one"""
+        if not self.enabled:
+            return
+        self.Collect()
+        if scene.manual_gc:
+            gc.disable()
+        else:
+            gc.enable()
+
+    def Stop(self):
+        """Give the control back to the automatic collection, e.g. on exit"""
+        if self.enabled:
+            gc.enable()
+
+    def TakeStats(self):
+        """Return the number of automatic collections since the last call"""
+        recent = self.recent
+        self.recent = 0
+        return recent
+
+    def PeakMemory(self):
+        """Peak resident memory of the process in bytes, None if unknown"""
+        if resource == None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports it in KiB, macOS in bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def Report(self):
+        peak = self.PeakMemory()
+        return "gc {}: {} automatic collections, pauses {:.2f} ms total, " \
+               "{:.2f} ms max; {} by the policy, {:.2f} ms total; peak memory " \
+               "{}".format("policy" if self.enabled else "automatic",
+               self.collections, self.pause * 1000, self.max_pause * 1000,
+               self.manual_collections, self.manual_pause * 1000,
+               "unknown" if peak == None else "{:.1f} MiB".format(peak / 2 ** 20))
+
+gc_policy = GcPolicy()
+
+class SimulationClock:
+    """Time source of the simulation. It is sampled once at the start of each
+       frame, so everything in the frame sees the same time. In virtual mode
+       it advances by given frame times instead (e.g. for replays)."""
+    def __init__(self):
+        self.now = None
+        # Time elapsed between the last two samples
+        self.dt = 0.0
+        self.virtual = False
+
+    def __call__(self):
+        if self.now == None:
+            return time.perf_counter()
+        return self.now
+
+    def Tick(self, dt=None):
+        """Start a new frame, dt is used only in virtual mode"""
+        if self.virtual:
+            self.dt = dt or 0.0
+            self.now = (self.now or 0.0) + self.dt
+        else:
+            now = time.perf_counter()
+            self.dt = now - self.now if self.now != None else 0.0
+            self.now = now
+
+    def SetVirtual(self, virtual):
+        self.virtual = virtual
+        self.now = None
+        self.dt = 0.0
+
+sim_clock = SimulationClock()
+
+class FixedTimestep:
+    """Accumulate the elapsed real time and convert it to fixed size
+       simulation steps, independently of the rendering rate"""
+    def __init__(self, step, max_steps, timer=sim_clock):
+        # Length of one simulation step in seconds
+        self.step = step
+        # Catch-up cap: never run more steps than this in one frame, the
+        # rest of the elapsed time is dropped (game slows down instead of
+        # freezing, when the simulation can't keep up)
+        self.max_steps = max_steps
+        self.timer = timer
+        self.dropped_steps = 0
+        self.Reset()
+
+    def Reset(self):
+        """Forget the elapsed time, e.g. when a scene becomes active again"""
+        self.last_time = None
+        self.accumulator = 0.0
+        # Ratio between the last two simulation states to render
+        self.alpha = 0.0
+
+    def Advance(self):
+        """Return the number of simulation steps to run in this frame"""
+        now = self.timer()
+        if self.last_time != None:
+            self.accumulator += now - self.last_time
+        self.last_time = now
+
+        steps = int(self.accumulator // self.step)
+        self.accumulator -= steps * self.step
+        if steps > self.max_steps:
+            self.dropped_steps += steps - self.max_steps
+            steps = self.max_steps
+
+        self.alpha = self.accumulator / self.step
+        return steps
+
+class PhysicsBody:
+    """Position, velocity and the forces acting on a body, integrated by RK4"""
+    def __init__(self, posx, posy, mass=1.0, drag=0.0):
+        self.posx = float(posx)
+        self.posy = float(posy)
+        self.velx = 0.0
+        self.vely = 0.0
+        self.forcex = 0.0
+        self.forcey = 0.0
+        self.mass = mass
+        # Linear drag coefficient (1/s), drag force is proportional to velocity
+        self.drag = drag
+
+    def ApplyForce(self, forcex, forcey):
+        self.forcex += forcex
+        self.forcey += forcey
+
+    def ClearForces(self):
+        self.forcex = 0.0
+        self.forcey = 0.0
+
+    def Integrate(self, dt):
+        self.posx, self.velx = rk4_axis(self.posx, self.velx, self.forcex,
+                                        self.mass, self.drag, dt)
+        self.posy, self.vely = rk4_axis(self.posy, self.vely, self.forcey,
+                                        self.mass, self.drag, dt)
+
+class LevelError(Exception):
+    pass
+
+class TileBody:
+    """Blocking area of a tilemap, a run of neighbouring blocking tiles"""
+    def __init__(self, rect):
+        self.rect = rect
+
+class Tilemap:
+    """Level built from tiles. Static tiles are baked into chunk surfaces
+       when they first get near the view, drawing a view blits only the
+       chunks which are visible. At most max_chunks baked chunks are kept,
+       the least recently drawn ones are dropped, so the memory doesn't
+       grow with the width of the level."""
+    def __init__(self, path, screen, chunk_tiles=8, max_chunks=32):
+        self.chunk_tiles = chunk_tiles
+        self.max_chunks = max_chunks
+        tiles_per_screen, self.tile_defs, self.map_rows = self.Parse(path)
+        rows = self.map_rows
+
+        self.tile_size = screen.get_width() // tiles_per_screen
+        self.rows = len(rows)
+        self.cols = max(len(row) for row in rows)
+        # The last row of the map is at the bottom of the screen
+        self.origin_y = screen.get_height() - self.rows * self.tile_size
+        self.rect = pygame.Rect(0, self.origin_y, self.cols * self.tile_size,
+                                self.rows * self.tile_size)
+
+        # Left edge of the bunny is in the middle of the spawn cell, its
+        # bottom is on the bottom of the cell
+        self.spawn = (self.tile_size // 2, screen.get_height())
+        for row_index, row in enumerate(rows):
+            if "S" in row:
+                self.spawn = (row.index("S") * self.tile_size + self.tile_size // 2,
+                              self.origin_y + (row_index + 1) * self.tile_size)
+
+        # Chunk coordinates -> baked surface of the chunk (None if it has no
+        # tiles), in the order of their last use
+        self.chunks = collections.OrderedDict()
+        self.bodies = []
+        self.FindBodies()
+
+    @classmethod
+    def Parse(cls, path):
+        """Read the level file, return the number of tiles per screen, the
+           tile definitions and the rows of the map with expanded repeats"""
+        tiles_per_screen = 10
+        tile_defs = {}
+        rows = []
+        in_map = False
+        try:
+            with open(path) as level_file:
+                for line in level_file:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if in_map:
+                        rows.append(cls.ExpandRow(line))
+                        continue
+                    words = line.split()
+                    if words[0] == "tiles_per_screen":
+                        tiles_per_screen = int(words[1])
+                    elif words[0] == "tile":
+                        outline = color_lib[words[4]] if len(words) > 4 else None
+                        tile_defs[words[1]] = (os.path.join(image_dir, words[2]),
+                                               words[3] == "blocking", outline)
+                    elif words[0] == "map":
+                        in_map = True
+                    else:
+                        raise LevelError("Unknown keyword: " + words[0])
+        except (OSError, ValueError, IndexError, KeyError) as message:
+            raise LevelError("Cannot load level " + path + ": " + str(message))
+        if not rows:
+            raise LevelError("Empty map in level " + path)
+        return tiles_per_screen, tile_defs, rows
+
+    @staticmethod
+    def ExpandRow(line):
+        """Expand the repeat counts of a map row: "3G.B" -> "GGG.B" """
+        row = []
+        count = ""
+        for char in line:
+            if char.isdigit():
+                count += char
+            else:
+                row.append(char * int(count or 1))
+                count = ""
+        return "".join(row)
+
+    def FindBodies(self):
+        size = self.tile_size
+        for row_index, row in enumerate(self.map_rows):
+            posy = self.origin_y + row_index * size
+            run_start = None
+            for col_index, char in enumerate(row + "."):
+                tile = self.tile_defs.get(char)
+
+                # Neighbouring blocking tiles in the same chunk form one body
+                blocking = tile != None and tile[1]
+                if run_start != None and (not blocking or
+                   col_index % self.chunk_tiles == 0):
+                    self.bodies.append(TileBody(pygame.Rect(run_start * size,
+                        posy, (col_index - run_start) * size, size)))
+                    run_start = None
+                if blocking and run_start == None:
+                    run_start = col_index
+
+    def Bake(self, key):
+        """Render the tiles of a chunk, return None if it has none"""
+        size = self.tile_size
+        first_col = key[0] * self.chunk_tiles
+        first_row = key[1] * self.chunk_tiles
+        chunk = None
+        for row_index in range(first_row, min(first_row + self.chunk_tiles, self.rows)):
+            row = self.map_rows[row_index]
+            for col_index in range(first_col, min(first_col + self.chunk_tiles, len(row))):
+                tile = self.tile_defs.get(row[col_index])
+                if tile == None:
+                    continue
+                if chunk == None:
+                    # Chunks of the last row and column cover only the
+                    # remaining tiles, a flat level needs only flat chunks
+                    chunk_w = min(self.chunk_tiles, self.cols - first_col)
+                    chunk_h = min(self.chunk_tiles, self.rows - first_row)
+                    chunk = pygame.Surface((chunk_w * size, chunk_h * size),
+                                           pygame.SRCALPHA, 32)
+                    chunk.fill((0, 0, 0, 0))
+                tile_rect = pygame.Rect((col_index - first_col) * size,
+                                        (row_index - first_row) * size,
+                                        size, size)
+                chunk.blit(load_variant(tile[0], size), tile_rect)
+                if tile[2] != None:
+                    pygame.draw.rect(chunk, tile[2], tile_rect, 1)
+
+        if chunk != None and pygame.display.get_surface() != None:
+            chunk = chunk.convert_alpha()
+        return chunk
+
+    def Chunk(self, key):
+        """Return the baked chunk (or None), bake it if it's not cached"""
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        chunk = self.Bake(key)
+        self.chunks[key] = chunk
+        return chunk
+
+    def AddBlocking(self, index):
+        """Register the blocking areas into a SpatialHash"""
+        for body in self.bodies:
+            index.Insert(body)
+
+    def Draw(self, screen, view):
+        """Blit the chunks visible in view (world coordinates) to the screen,
+           the upper-left corner of view is drawn to the upper-left corner of
+           the screen. Return the number of blitted chunks. Chunks are placed
+           by their upper-left corner, so the smaller ones at the edges of
+           the map need no special handling.
+           Chunks one chunk away from the view are baked as well, so they are
+           usually ready before they are scrolled in."""
+        chunk_px = self.chunk_tiles * self.tile_size
+        first_x = view.x // chunk_px
+        first_y = (view.y - self.origin_y) // chunk_px
+        last_x = (view.x + view.w - 1) // chunk_px
+        last_y = (view.y + view.h - 1 - self.origin_y) // chunk_px
+        last_col = (self.cols - 1) // self.chunk_tiles
+        last_row = (self.rows - 1) // self.chunk_tiles
+        blits = 0
+        used = 0
+        for cx in range(max(first_x - 1, 0), min(last_x + 1, last_col) + 1):
+            for cy in range(max(first_y - 1, 0), min(last_y + 1, last_row) + 1):
+                chunk = self.Chunk((cx, cy))
+                used += 1
+                if chunk != None and first_x <= cx <= last_x and first_y <= cy <= last_y:
+                    screen.blit(chunk, (cx * chunk_px - view.x,
+                                        self.origin_y + cy * chunk_px - view.y))
+                    blits += 1
+
+        # The chunks of this draw are the most recent ones, never drop them
+        while len(self.chunks) > max(self.max_chunks, used):
+            self.chunks.popitem(last=False)
+        return blits
+
+class DirtyRenderer:
+    """Keep a cached background and redraw only what moving sprites covered"""
+    def __init__(self, window, background):
+        self.window = window
+        self.background = background
+        # Rect and look of each sprite at the time it was last drawn
+        self.drawn = {}
+        self.dirty_rects = []
+        self.pixels_pushed = 0
+        self.full_redraw = True
+        # Number of blits in the last Draw
+        self.blit_count = 0
+
+    def Invalidate(self):
+        """Force the next Draw to restore the whole window"""
+        self.full_redraw = True
+
+    def Draw(self, screen, sprites, camera=None, restore=()):
+        """Blit sprites which changed since the last frame, return the
+           list of rects which have to be pushed to the display.
+           Sprites are drawn at their draw_rect, not at their collision rect.
+           With a camera, draw_rect is in world coordinates and the sprites
+           outside of the view are skipped.
+           Rects of 'restore' (screen coordinates) are restored as well, e.g.
+           the area of things drawn over the sprites in the last frame."""
+        if camera != None:
+            placed = [(sprite, camera.ToScreen(sprite.draw_rect))
+                      for sprite in camera.Cull(sprites)]
+        else:
+            placed = [(sprite, sprite.draw_rect) for sprite in sprites]
+
+        restored = []
+        if self.full_redraw:
+            screen.blit(self.background, self.window)
+            restored.append(self.window)
+            self.drawn.clear()
+        else:
+            # Sprites which disappeared since the last frame leave their
+            # old place behind, which has to be restored as well
+            restored.extend(rect.copy() for rect in restore)
+            current = set(sprite for sprite, rect in placed)
+            for sprite in [s for s in self.drawn if s not in current]:
+                restored.append(self.drawn.pop(sprite)[0])
+            for sprite, rect in placed:
+                old = self.drawn.get(sprite)
+                if old == None:
+                    restored.append(rect.copy())
+                elif old[0] != rect or old[1] is not sprite.look:
+                    restored.append(old[0])
+                    restored.append(rect.copy())
+            # Unchanged sprites touching a restored area are drawn again, their
+            # whole area has to be restored first, otherwise translucent
+            # pixels would be blended over themselves
+            unchanged = [rect for sprite, rect in placed if rect not in restored]
+            touched = True
+            while touched:
+                touched = [rect for rect in unchanged if rect.collidelist(restored) != -1]
+                restored.extend(rect.copy() for rect in touched)
+                unchanged = [rect for rect in unchanged if rect not in touched]
+            # Replace old positions of the changed sprites with the background
+            for rect in restored:
+                screen.blit(self.background, rect,
+                            rect.move(-self.window.x, -self.window.y))
+
+        self.blit_count = len(restored)
+
+        # Every sprite touching a restored area has to be redrawn, even the
+        # ones which didn't move, because they could be partially erased
+        for sprite, rect in placed:
+            if self.full_redraw or rect.collidelist(restored) != -1:
+                screen.blit(sprite.look, rect)
+                self.drawn[sprite] = (rect.copy(), sprite.look)
+                self.blit_count += 1
+
+        self.dirty_rects = [rect.clip(self.window) for rect in restored]
+        self.pixels_pushed = sum(rect.w * rect.h for rect in self.dirty_rects)
+        self.full_redraw = False
+        return self.dirty_rects
+
+class Camera:
+    """View of the world shown in the window. Follows a target smoothly, but
+       only when it leaves the dead zone in the middle of the view."""
+    def __init__(self, window, world, dead_zone=(0.3, 0.4), smoothing=8.0):
+        self.window = window
+        # The view never leaves the world rect
+        self.world = world
+        self.rect = pygame.Rect(world.x, world.y, window.w, window.h)
+        self.posx = float(self.rect.x)
+        self.posy = float(self.rect.y)
+        # Size of the dead zone, as a ratio of the view size
+        self.dead_zone = dead_zone
+        # How fast the view catches up with the target (1/sec)
+        self.smoothing = smoothing
+
+    def Target(self, target):
+        """Return the view position, which puts target inside the dead zone"""
+        zone_w = int(self.rect.w * self.dead_zone[0])
+        zone_h = int(self.rect.h * self.dead_zone[1])
+        zone_x = self.posx + (self.rect.w - zone_w) / 2
+        zone_y = self.posy + (self.rect.h - zone_h) / 2
+        posx, posy = self.posx, self.posy
+        if target.x < zone_x:
+            posx -= zone_x - target.x
+        elif target.x + target.w > zone_x + zone_w:
+            posx += target.x + target.w - (zone_x + zone_w)
+        if target.y < zone_y:
+            posy -= zone_y - target.y
+        elif target.y + target.h > zone_y + zone_h:
+            posy += target.y + target.h - (zone_y + zone_h)
+        return posx, posy
+
+    def Snap(self, target):
+        """Jump to the target without smoothing, e.g. when a level starts"""
+        self.posx, self.posy = self.Target(target)
+        self.Clamp()
+
+    def Follow(self, target, dt):
+        posx, posy = self.Target(target)
+        # Exponential smoothing, independent of the frame rate
+        ratio = 1 - math.exp(-self.smoothing * dt)
+        self.posx += (posx - self.posx) * ratio
+        self.posy += (posy - self.posy) * ratio
+        self.Clamp()
+
+    def Clamp(self):
+        self.posx = max(self.world.x, min(self.posx, self.world.right - self.rect.w))
+        self.posy = max(self.world.y, min(self.posy, self.world.bottom - self.rect.h))
+        self.rect.x = round(self.posx)
+        self.rect.y = round(self.posy)
+
+    def ToScreen(self, rect):
+        return rect.move(self.window.x - self.rect.x, self.window.y - self.rect.y)
+
+    def ToWorld(self, pos):
+        return (pos[0] - self.window.x + self.rect.x, pos[1] - self.window.y + self.rect.y)
+
+    def IsVisible(self, rect, margin=0):
+        return self.rect.inflate(2 * margin, 2 * margin).colliderect(rect)
+
+    def Cull(self, sprites, margin=0):
+        """Return the sprites whose draw_rect is (nearly) inside the view, used
+           for skipping the drawing and the logic of far away objects"""
+        view = self.rect.inflate(2 * margin, 2 * margin)
+        return [sprite for sprite in sprites if view.colliderect(sprite.draw_rect)]
+
+class SceneRegistry:
+    """Keep the created scenes for the current display mode, so switching
+       between them doesn't have to build them again"""
+    def __init__(self):
+        self.scenes = {}
+        self.mode = None
+
+    def Get(self, scene_class, screen, active_scene=None):
+        """Return the stored scene of the given class, or create a new one"""
+        mode = (screen.get_size(), screen.get_flags() & pygame.FULLSCREEN)
+        # Scenes laid out for another display mode have to be rebuilt
+        if mode != self.mode:
+            self.scenes.clear()
+            self.mode = mode
+
+        key = (scene_class, mode[0], mode[1])
+        scene = self.scenes.get(key)
+        if scene == None:
+            scene = scene_class(screen, active_scene)
+            if scene.cacheable:
+                self.scenes[key] = scene
+        else:
+            scene.Resume(screen)
+        return scene
+
+    def Clear(self):
+        self.scenes.clear()
+
+scene_registry = SceneRegistry()
+
+class InputLogError(Exception):
+    pass
+
+class InputLog:
+    """Binary input log of a game session, one record for each frame:
+           frame time change (us, zigzag varint)
+           number of pressed key changes, then the changed key indices as
+           increments from the previous one (varints)
+           number of events, then each event: type code, key or button,
+           and for mouse events the position (varints)"""
+    magic = b"HKIN"
+    version = 1
+    event_codes = {pygame.KEYDOWN: 0, pygame.KEYUP: 1,
+                   pygame.MOUSEBUTTONDOWN: 2, pygame.MOUSEBUTTONUP: 3}
+    event_types = inverse_dict(event_codes)
+
+class InputRecorder(InputLog):
+    """Write the input of each frame to an input log. Only the event types
+       reacted to by the scenes are recorded."""
+    def __init__(self, path, resolution, fullscreen):
+        self.log_file = open(path, "wb")
+        header = bytearray(self.magic)
+        header.append(self.version)
+        write_varint(header, resolution[0])
+        write_varint(header, resolution[1])
+        write_varint(header, 1 if fullscreen else 0)
+        self.log_file.write(header)
+        self.prev_keys = None
+        self.prev_dt = 0
+
+    def Record(self, events, pressed_keys, dt):
+        record = bytearray()
+        dt = int(round(dt * 1000000))
+        write_varint(record, zigzag(dt - self.prev_dt))
+        self.prev_dt = dt
+
+        # Store only the keys which changed state since the last frame
+        keys = [bool(state) for state in pressed_keys]
+        prev_keys = self.prev_keys or [False] * len(keys)
+        changed = [index for index, state in enumerate(keys)
+                   if state != prev_keys[index]]
+        self.prev_keys = keys
+        write_varint(record, len(changed))
+        prev_index = 0
+        for index in changed:
+            write_varint(record, index - prev_index)
+            prev_index = index
+
+        events = [event for event in events if event.type in self.event_codes]
+        write_varint(record, len(events))
+        for event in events:
+            record.append(self.event_codes[event.type])
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                write_varint(record, event.key)
+            else:
+                write_varint(record, event.button)
+                write_varint(record, max(event.pos[0], 0))
+                write_varint(record, max(event.pos[1], 0))
+        self.log_file.write(record)
+
+    def Close(self):
+        self.log_file.close()
+
+class InputReplayer(InputLog):
+    """Read back an input log frame by frame. The simulation clock is switched
+       to virtual time, advanced by the recorded frame times, or by
+       frame_time if it is given."""
+    def __init__(self, path, frame_time=None):
+        with open(path, "rb") as log_file:
+            self.data = log_file.read()
+        if self.data[:len(self.magic)] != self.magic or \
+           self.data[len(self.magic)] != self.version:
+            raise InputLogError("Not an input log: " + path)
+        pos = len(self.magic) + 1
+        width, pos = read_varint(self.data, pos)
+        height, pos = read_varint(self.data, pos)
+        fullscreen, pos = read_varint(self.data, pos)
+        self.resolution = (width, height)
+        self.fullscreen = bool(fullscreen)
+        self.pos = pos
+        self.frame_time = frame_time
+        self.dt = 0
+        self.keys = None
+        self.frames = 0
+        sim_clock.SetVirtual(True)
+
+    def Next(self, pressed_keys):
+        """Return the events and pressed keys of the next frame, or None at the
+           end of the log. pressed_keys is the live state, its type is used
+           for the replayed state too."""
+        data = self.data
+        if self.pos >= len(data):
+            return None
+        delta, pos = read_varint(data, self.pos)
+        self.dt += unzigzag(delta)
+
+        if self.keys == None:
+            self.keys = [False] * len(pressed_keys)
+        count, pos = read_varint(data, pos)
+        index = 0
+        for i in range(count):
+            increment, pos = read_varint(data, pos)
+            index += increment
+            self.keys[index] = not self.keys[index]
+
+        events = []
+        count, pos = read_varint(data, pos)
+        for i in range(count):
+            event_type = self.event_types[data[pos]]
+            pos += 1
+            if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+                key, pos = read_varint(data, pos)
+                events.append(pygame.event.Event(event_type, key=key, mod=0,
+                                                 unicode="", scancode=0))
+            else:
+                button, pos = read_varint(data, pos)
+                posx, pos = read_varint(data, pos)
+                posy, pos = read_varint(data, pos)
+                events.append(pygame.event.Event(event_type, button=button,
+                                                 pos=(posx, posy)))
+        self.pos = pos
+        self.frames += 1
+
+        sim_clock.Tick(self.frame_time or self.dt / 1000000)
+        return events, type(pressed_keys)(self.keys)
+
+    def Close(self):
+        sim_clock.SetVirtual(False)
+
+class NullZone:
+    """Timing zone of a disabled profiler, does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class ProfileZone:
+    """Measures the time spent inside a with statement"""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.AddTime(self.name, time.perf_counter() - self.start)
+        return False
+
+class FrameProfiler:
+    """Per frame timings and counters, stored in a ring buffer of the last
+       'size' frames. Does (almost) nothing while disabled."""
+    # Colors of the phases on the overlay graph, other zones are not drawn
+    graph_colors = collections.OrderedDict((
+        ("input", color_lib["yellow"]),
+        ("update", color_lib["red"]),
+        ("output", color_lib["green"]),
+        ("present", color_lib["skyblue"]),
+        ("collect", color_lib["pink"])))
+
+    def __init__(self, size=600):
+        self.size = size
+        self.enabled = False
+        self.visible = False
+        # Name -> list of 'size' values, one for each frame in the ring
+        self.columns = collections.OrderedDict()
+        # Values of the frame in progress
+        self.current = {}
+        self.index = 0
+        self.frames = 0
+        self.frame_start = None
+        self.null_zone = NullZone()
+        self.overlay_rect = None
+
+    def Toggle(self):
+        """Start or stop recording, and show or hide the overlay"""
+        self.enabled = not self.enabled
+        self.visible = self.enabled
+        self.current = {}
+        # The frame in progress is recorded from this point
+        self.frame_start = time.perf_counter() if self.enabled else None
+
+    def Zone(self, name):
+        """Context manager measuring a named zone, usable with any name:
+           with profiler.Zone("my_zone"): ..."""
+        if not self.enabled:
+            return self.null_zone
+        return ProfileZone(self, name)
+
+    def AddTime(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def Count(self, name, value=1):
+        if self.enabled:
+            self.current[name] = self.current.get(name, 0) + value
+
+    def BeginFrame(self):
+        if self.enabled:
+            self.frame_start = time.perf_counter()
+
+    def EndFrame(self):
+        """Store the values of the frame into the ring buffer"""
+        if not self.enabled or self.frame_start == None:
+            return
+        # Waiting for the next frame is not part of the frame time
+        self.current["frame"] = time.perf_counter() - self.frame_start - \
+                                self.current.get("tick", 0.0)
+        for name in self.current:
+            if name not in self.columns:
+                self.columns[name] = [0] * self.size
+        for name, column in self.columns.items():
+            column[self.index] = self.current.get(name, 0)
+        self.index = (self.index + 1) % self.size
+        self.frames += 1
+        self.current = {}
+
+    def Last(self, name, count=None):
+        """Values of the last 'count' frames, the oldest first"""
+        recorded = min(self.frames, self.size)
+        count = recorded if count == None else min(count, recorded)
+        column = self.columns.get(name, [0] * self.size)
+        return [column[(self.index - count + i) % self.size] for i in range(count)]
+
+    def DumpCSV(self, path):
+        """Write the frames in the ring buffer to a CSV file"""
+        names = list(self.columns)
+        first = self.frames - min(self.frames, self.size)
+        columns = [self.Last(name) for name in names]
+        with open(path, "w") as csv_file:
+            csv_file.write(",".join(["frame_index"] + names) + "\n")
+            for row, values in enumerate(zip(*columns)):
+                csv_file.write(",".join([str(first + row)] +
+                                        [str(value) for value in values]) + "\n")
+
+    def DrawOverlay(self, screen, width=240, height=80):
+        """Draw the frame time graph of the recent frames, return its rect"""
+        if not self.visible:
+            self.overlay_rect = None
+            return None
+        atlas = load_atlas(default_font, 16, color_lib["white"])
+        # The panel is wide enough for the longest text, so nothing is left
+        # behind outside of it when the text changes
+        width = max(width, atlas.Size("avg 000.00 max 000.00 ms")[0] + 4)
+        rect = pygame.Rect(0, 0, min(width, screen.get_width()), height)
+        screen.fill(color_lib["black"], rect)
+
+        # Stacked bars of the phases, one pixel wide for each frame, the
+        # full height of the graph is 2 * 1/60 sec
+        scale = (height - 20) / (2 / 60)
+        phases = [(self.Last(name, rect.w), color)
+                  for name, color in self.graph_colors.items()]
+        for frame in range(len(phases[0][0])):
+            bottom = rect.bottom
+            for values, color in phases:
+                bar = int(values[frame] * scale)
+                if bar > 0:
+                    screen.fill(color, (rect.x + frame, bottom - bar, 1, bar))
+                    bottom -= bar
+        # 60 fps limit
+        limit_y = rect.bottom - int(scale / 60)
+        screen.fill(color_lib["white"], (rect.x, limit_y, rect.w, 1))
+
+        frame_times = self.Last("frame", 60)
+        average = sum(frame_times) / len(frame_times) if frame_times else 0.0
+        atlas.Draw(screen, "avg {:.2f} max {:.2f} ms".format(average * 1000,
+                   max(frame_times or [0]) * 1000), (rect.x + 2, rect.y + 1))
+        self.overlay_rect = rect
+        return rect
+
+profiler = FrameProfiler()
+
 class SceneBase:
+    # Images and (font, size) pairs used by the scene, which can be loaded in
+    # the background before the scene is created (see Manifest)
+    manifest = {"images": (), "fonts": ()}
+    # Scenes without state worth resetting are reused by SceneRegistry
+    cacheable = False
+    mouse_visible = True
+    # Arguments of pygame.key.set_repeat, empty means no key repeat
+    key_repeat = ()
+    # While the scene is idle, the main loop wakes up at least this often
+    # (msec) without events, e.g. for animations or background loading
+    idle_timeout = 250
+    # No automatic garbage collection while the scene is active (see GcPolicy)
+    manual_gc = False
+
+    @classmethod
+    def Manifest(cls, screen):
+        """Return the manifest of the scene for the given screen. Scenes which
+           depend on the screen (e.g. on the variant sizes) override it"""
+        return cls.manifest
+
     def __init__(self, screen, window):
         self.window = window
-        pygame.mouse.set_visible(True)
-        pygame.key.set_repeat()
+        # List of changed rects after GenerateOutput, or None if the whole
+        # screen has to be updated
+        self.dirty_rects = None
+        # Set by GenerateOutput if nothing changed, the main loop waits for
+        # events instead of rendering frames then
+        self.idle = False
+        # The screen shows the output of the scene. Cleared when something
+        # else could have drawn over it
+        self.drawn = False
+        self.SetupInput()
+
+    def SetupInput(self):
+        pygame.mouse.set_visible(self.mouse_visible)
+        pygame.key.set_repeat(*self.key_repeat)
+
+    def Suspend(self):
+        """Called when another scene becomes active"""
+        pass
+
+    def Resume(self, screen):
+        """Called when a stored scene becomes active again"""
+        self.SetupInput()
+        self.drawn = False
+
+    def Invalidate(self):
+        """Redraw the whole screen in the next GenerateOutput, e.g. after
+           something else has drawn over it"""
+        self.drawn = False
 
     def ProcessInput(self, screen, events, pressed_keys):
         """Receives all events occured since last frame and
@@ -351,6 +2273,241 @@ class SceneBase:
         """Update screen, render new frame and show to the user."""
         print("Forget to override this in the child class!")
 
+def wait_event(timeout):
+    """Block until an event arrives, or timeout (msec) passes. Return the
+       event, or None after the timeout."""
+    try:
+        event = pygame.event.wait(timeout)
+    except TypeError:
+        # No timeout before pygame 2, poll with short sleeps instead
+        end = time.perf_counter() + timeout / 1000.0
+        event = pygame.event.poll()
+        while event.type == pygame.NOEVENT and time.perf_counter() < end:
+            pygame.time.wait(5)
+            event = pygame.event.poll()
+    if event.type == pygame.NOEVENT:
+        return None
+    return event
+
+class FramePacer:
+    """Keep the frame rate with one of the pacing strategies, and measure the
+       jitter of the frame intervals:
+           "tick"   Clock.tick sleeps until the next frame, uses little CPU,
+                    but wakes up late by up to a few msec
+           "busy"   Clock.tick_busy_loop spins until the next frame, precise,
+                    but uses a whole core
+           "vsync"  presenting the frame waits for the vertical blank, the
+                    display has to be created with vsync (see set_display_mode
+                    in hellokitty.py)"""
+    strategies = ("tick", "busy", "vsync")
+
+    def __init__(self, strategy="tick", history=600):
+        if strategy not in self.strategies:
+            raise ValueError("Unknown pacing strategy: " + strategy)
+        self.strategy = strategy
+        self.clock = pygame.time.Clock()
+        self.intervals = collections.deque(maxlen=history)
+        self.last = None
+
+    def Wait(self, fps, presented=True):
+        """Wait for the next frame (no wait with fps 0), record the interval.
+           presented is False if the frame pushed nothing to the display, the
+           vsync strategy has to keep the rate with tick then"""
+        if fps and (self.strategy == "tick" or
+                    (self.strategy == "vsync" and not presented)):
+            self.clock.tick(fps)
+        elif fps and self.strategy == "busy":
+            self.clock.tick_busy_loop(fps)
+        now = time.perf_counter()
+        if self.last != None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    def Reset(self):
+        """Don't measure the interval to the next frame, e.g. after waiting
+           for events in an idle scene"""
+        self.last = None
+        self.clock.tick()
+
+    def Jitter(self):
+        """Return the mean frame interval, its standard deviation and the
+           largest deviation from the mean, in msec"""
+        count = len(self.intervals)
+        if count == 0:
+            return 0.0, 0.0, 0.0
+        mean = sum(self.intervals) / count
+        deviation = math.sqrt(sum((i - mean) ** 2 for i in self.intervals) / count)
+        largest = max(abs(i - mean) for i in self.intervals)
+        return mean * 1000, deviation * 1000, largest * 1000
+
+    def Report(self):
+        mean, deviation, largest = self.Jitter()
+        return "{} pacing: {} frames, interval {:.2f} ms, jitter {:.3f} ms " \
+               "(max {:.3f} ms)".format(self.strategy, len(self.intervals),
+                                         mean, deviation, largest)
+
+class StartupTimer:
+    """Time of the startup phases until the first frame is shown, and the
+       startup work deferred until then"""
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.deferred = []
+        self.done = False
+
+    def Add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def Mark(self, name):
+        """End the current phase, which gets the given name"""
+        now = time.perf_counter()
+        self.Add(name, now - self.last)
+        self.last = now
+
+    def Defer(self, function, *args):
+        """Run function after the first frame is shown"""
+        self.deferred.append((function, args))
+
+    def FirstFrame(self):
+        """Call after each frame, only the first call does anything"""
+        if self.done:
+            return
+        self.done = True
+        self.Mark("first_frame")
+        for function, args in self.deferred:
+            function(*args)
+        self.deferred = []
+        self.Mark("deferred")
+
+    def Report(self):
+        """Lines of the timing breakdown, in milliseconds"""
+        lines = ["{:<12} {:8.2f} ms".format(name, seconds * 1000)
+                 for name, seconds in self.phases.items()]
+        lines.append("{:<12} {:8.2f} ms".format("total", sum(self.phases.values()) * 1000))
+        return lines
+
+class AudioManager:
+    """Sound effects on a fixed pool of reserved channels, and the music.
+       Effects are decoded into memory when the audio starts, playing them
+       only starts a channel, so it never waits for decoding or the disk.
+       When all channels are busy, a new effect takes the channel of the
+       lowest priority (then the oldest) effect which is not more important
+       than itself, otherwise it's dropped."""
+    def __init__(self, channels=8):
+        self.channel_count = channels
+        self.enabled = False
+        self.started = False
+        self.channels = []
+        # Priority and start time of the effect on each channel
+        self.voices = []
+        # Effect name -> (source, priority, volume), the source is a sound
+        # file path or a function which returns a Sound
+        self.effects = {}
+        # Effect name -> decoded Sound
+        self.sounds = {}
+        # Path and loops of the music to play, and whether it's loaded
+        self.music = None
+        self.music_loops = -1
+        self.music_loaded = False
+        self.stats = {"played": 0, "stolen": 0, "dropped": 0}
+
+    def Register(self, name, source, priority=0, volume=1.0):
+        self.effects[name] = (source, priority, volume)
+        if self.started:
+            self.Decode(name)
+
+    def Decode(self, name):
+        source, priority, volume = self.effects[name]
+        if callable(source):
+            sound = source()
+        else:
+            sound = load_sound(source)
+        sound.set_volume(volume)
+        self.sounds[name] = sound
+
+    def Start(self):
+        """Initialize the mixer and decode the registered effects, return
+           False if there's no audio device"""
+        if self.started:
+            return True
+        if not init_mixer():
+            return False
+        # Reserved channels are never picked by Sound.play, only by Play
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(),
+                                          self.channel_count))
+        pygame.mixer.set_reserved(self.channel_count)
+        self.channels = [pygame.mixer.Channel(i) for i in range(self.channel_count)]
+        self.voices = [(0, 0.0)] * self.channel_count
+        self.started = True
+        for name in self.effects:
+            self.Decode(name)
+        return True
+
+    def SetEnabled(self, enabled):
+        """Switch the audio on and off, the mixer is started on first use"""
+        self.enabled = enabled and self.Start()
+        if self.started and not self.enabled:
+            for channel in self.channels:
+                channel.stop()
+            pygame.mixer.music.pause()
+        elif self.enabled and self.music_loaded:
+            pygame.mixer.music.unpause()
+        elif self.enabled and self.music != None:
+            self.StartMusic()
+
+    def Play(self, name):
+        """Start an effect, without waiting for anything"""
+        if not self.enabled:
+            return
+        sound = self.sounds.get(name)
+        if sound == None:
+            return
+        priority = self.effects[name][1]
+
+        index = None
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                index = i
+                break
+        if index == None:
+            # Voice stealing
+            index = min(range(len(self.voices)), key=lambda i: self.voices[i])
+            if self.voices[index][0] > priority:
+                self.stats["dropped"] += 1
+                return
+            self.stats["stolen"] += 1
+        self.channels[index].play(sound)
+        self.voices[index] = (priority, time.perf_counter())
+        self.stats["played"] += 1
+
+    def PlayMusic(self, path, loops=-1):
+        """Stream music from a file, only opening it is done here. If the
+           audio is off, it starts when the audio is switched on."""
+        self.music = load_music(path)
+        self.music_loops = loops
+        self.music_loaded = False
+        if self.enabled:
+            self.StartMusic()
+
+    def StartMusic(self):
+        pygame.mixer.music.load(self.music)
+        pygame.mixer.music.play(self.music_loops)
+        self.music_loaded = True
+
+    def StopMusic(self):
+        self.music = None
+        self.music_loaded = False
+        if self.started:
+            pygame.mixer.music.stop()
+
+    def TakeStats(self):
+        """Return the playback counters, and start counting again"""
+        stats = self.stats
+        self.stats = {"played": 0, "stolen": 0, "dropped": 0}
+        return stats
+
+audio = AudioManager()
+
 ################################ CHECK LOAD TYPE ###############################
 
 if __name__ == "__main__":
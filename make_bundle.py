@@ -0,0 +1,62 @@
+#! /usr/bin/python3
+r"""
+Write the asset bundle of the game (see AssetBundle in libfalcon.py)
+
+The bundle holds every image of the image directory as raw RGBA pixels, the
+scaled variants which the game uses at each resolution in _resolutions, and
+the font files. The variants are found by creating the game scene at each
+resolution with the dummy SDL video driver, so the bundle has exactly what
+the game asks for. The game uses the bundle when it's next to hellokitty.py,
+and falls back to the loose files for anything missing or changed since.
+
+Usage: make_bundle.py [output_file]
+"""
+
+import os
+import sys
+import time
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+import libfalcon
+import hellokitty
+
+image_extensions = (".png", ".jpg", ".bmp")
+font_extensions = (".ttf", ".otf")
+
+def collect_files(directory, extensions):
+    return sorted(os.path.join(directory, entry.name)
+                  for entry in os.scandir(directory)
+                  if entry.is_file() and entry.name.lower().endswith(extensions))
+
+def collect_variants(resolution):
+    """Return the variants loaded by the game scene at the given resolution"""
+    screen = pygame.display.set_mode(resolution)
+    libfalcon.invalidate_variants()
+    hellokitty.GameScene(screen)
+    return {(path, width, trim): variant
+            for (path, width, flip, trim), variant in libfalcon.variant_lib.items()
+            if not flip}
+
+if __name__ == "__main__":
+    # Relative paths of the media files are resolved from the game directory
+    output = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else hellokitty._asset_bundle)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+
+    libfalcon.init_subsystems(False)
+    images = {path: pygame.image.load(path)
+              for path in collect_files(libfalcon.image_dir, image_extensions)}
+    variants = {}
+    for resolution in hellokitty._resolutions:
+        variants.update(collect_variants(resolution))
+    fonts = {path: libfalcon.read_file(path)
+             for path in collect_files(libfalcon.font_dir, font_extensions)}
+    pygame.quit()
+
+    libfalcon.AssetBundle.Write(output, images, variants, fonts)
+    print("{} images, {} variants, {} fonts: {} ({:.1f} MB) in {:.2f} sec".format(
+          len(images), len(variants), len(fonts), output,
+          os.path.getsize(output) / (1024 * 1024), time.perf_counter() - start))